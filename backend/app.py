@@ -1,7 +1,8 @@
 from flask import Flask
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager
-from database import db, FineTuneData
+from database import db, FineTuneData, ensure_schema
 from config import Config
 from routes.auth import auth_bp
 from routes.chat import chat_bp
@@ -9,12 +10,49 @@ from routes.models import models_bp
 from routes.admin import admin_bp
 import threading
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import atexit
+import queue
+import orjson
 
 logger = logging.getLogger(__name__)
 
+class ORJSONProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson for jsonify() and request.get_json()"""
+    def dumps(self, obj, **kwargs):
+        # Map the json.dumps options Flask passes onto orjson's; non-str dict
+        # keys are stringified as the stdlib provider does
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=kwargs.get('default', self.default), option=option).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+def configure_logging(level):
+    """Log through a queue so request threads never block on handler I/O"""
+    root_logger = logging.getLogger()
+    root_logger.setLevel(level)
+    if any(isinstance(handler, QueueHandler) for handler in root_logger.handlers):
+        return  # Already configured (create_app called again)
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    log_queue = queue.SimpleQueue()
+    root_logger.addHandler(QueueHandler(log_queue))
+
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
 def create_app():
     app = Flask(__name__)
+    app.json = ORJSONProvider(app)
     app.config.from_object(Config)
+    configure_logging(app.config['LOG_LEVEL'])
     
     # Initialize extensions
     db.init_app(app)
@@ -32,19 +70,26 @@ def create_app():
         # Drop tables to handle schema changes (dev only)
         # db.drop_all()
         db.create_all()
+        ensure_schema()
 
-    # Start background model pre-loading if configured
+    # Prefetch model weights in a separate process if configured, so the
+    # download does not compete with request threads for the GIL. Under
+    # gunicorn the master already started it (on_starting), once for all
+    # workers, and this returns its event
+    weights_prefetched = None
     if Config.PRELOAD_HF_MODELS:
-        def start_preloading():
-            with app.app_context():
-                from services.huggingface_service import create_huggingface_service
-                hf_service = create_huggingface_service()
-                logger.info(f"Starting pre-loading of models: {Config.PRELOAD_HF_MODELS}")
-                hf_service.preload_models(Config.PRELOAD_HF_MODELS)
+        from services.huggingface_service import start_weights_prefetch
+        weights_prefetched = start_weights_prefetch(Config.PRELOAD_HF_MODELS)
+
+        # Then load them into the shared service so the first chat request
+        # doesn't pay the load; waiting for the prefetch means loading reads
+        # from the local cache instead of racing the download
+        def warm_models():
+            weights_prefetched.wait()
+            from services.huggingface_service import create_huggingface_service
+            create_huggingface_service().preload_models(Config.PRELOAD_HF_MODELS)
 
-        # Start pre-loading in background thread
-        preload_thread = threading.Thread(target=start_preloading, daemon=True)
-        preload_thread.start()
+        threading.Thread(target=warm_models, daemon=True).start()
 
     @app.route('/api/health')
     def health_check():
@@ -55,7 +100,8 @@ def create_app():
         return {
             "status": "healthy",
             "message": "Ollama Chatbot API is running",
-            "model_loading_status": model_status
+            "model_loading_status": model_status,
+            "weights_prefetched": weights_prefetched is not None and weights_prefetched.is_set()
         }
 
     return app
@@ -5,10 +5,43 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'your-secret-key-change-in-production'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///chatbot.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Reuse a small pool of SQLite connections instead of reopening the file
+    # per request (in-memory databases get a StaticPool from Flask-SQLAlchemy)
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        "pool_size": 5,
+        "max_overflow": 10,
+        "pool_pre_ping": True,
+        "connect_args": {"check_same_thread": False, "timeout": 30}
+    } if SQLALCHEMY_DATABASE_URI.startswith('sqlite:///') and ':memory:' not in SQLALCHEMY_DATABASE_URI else {}
     JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY') or 'jwt-secret-change-in-production'
     JWT_ACCESS_TOKEN_EXPIRES = timedelta(hours=24)
+    # bcrypt work factor for new password hashes; each +1 doubles hashing time
+    BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS') or 12)
+    LOG_LEVEL = os.environ.get('LOG_LEVEL') or 'INFO'
     OLLAMA_BASE_URL = 'http://localhost:11434'
+    # Number of most recent messages sent to Ollama as conversation context
+    CHAT_CONTEXT_WINDOW = int(os.environ.get('CHAT_CONTEXT_WINDOW') or 20)
     GHANANLP_API_KEY = os.environ.get('GHANANLP_API_KEY') or 'your-ghananlp-api-key-here'
+    # HuggingFace weight quantization on GPU: '4bit', '8bit' or unset for
+    # plain FP16/BF16 (quantization needs the bitsandbytes package)
+    HF_QUANTIZATION = os.environ.get('HF_QUANTIZATION') or None
+    # Quantize the HuggingFace KV cache to this many bits during generation
+    # (e.g. 8); halves cache memory vs FP16. Needs the optional package of
+    # HF_KV_CACHE_BACKEND: 'quanto' (optimum-quanto) or 'hqq' (hqq)
+    HF_KV_CACHE_BITS = int(os.environ.get('HF_KV_CACHE_BITS') or 0) or None
+    HF_KV_CACHE_BACKEND = os.environ.get('HF_KV_CACHE_BACKEND', 'quanto').lower()
+    # Compile HuggingFace/Whisper forward passes with torch.compile; the
+    # compile happens once at load time during a warm-up generate
+    TORCH_COMPILE = os.environ.get('TORCH_COMPILE', '').lower() in ('1', 'true', 'yes')
+    # Run Whisper ASR with CTranslate2 (int8) from this directory instead of
+    # PyTorch; converted from the HF checkpoint on first start if missing.
+    # Needs the optional ctranslate2 package
+    WHISPER_CT2_DIR = os.environ.get('WHISPER_CT2_DIR') or None
+    # Dynamically quantize the PyTorch Whisper model's Linear layers to int8
+    # when it runs on CPU (weights int8, activations quantized per batch)
+    WHISPER_INT8 = os.environ.get('WHISPER_INT8', '').lower() in ('1', 'true', 'yes')
+    # Size cap for the on-disk TTS cache; least recently used clips are evicted
+    TTS_CACHE_MAX_BYTES = int(os.environ.get('TTS_CACHE_MAX_BYTES') or 1 << 30)
     # HuggingFace model pre-loading configuration
     PRELOAD_HF_MODELS = [
         "FelixYaw/twi-lora-model",
@@ -1,38 +1,132 @@
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import raiseload
 from datetime import datetime
+import os
+import sqlite3
+import time
 import uuid
 
 db = SQLAlchemy()
 
+def uuid7() -> str:
+    """Generate a time-ordered UUIDv7 string for primary keys.
+
+    Same 36-char format as uuid4, but successive ids sort by creation time, so
+    inserts append to the index btree instead of splitting random pages.
+    """
+    unix_ts_ms = time.time_ns() // 1_000_000
+    rand = int.from_bytes(os.urandom(10), 'big')
+    value = (unix_ts_ms & ((1 << 48) - 1)) << 80  # 48-bit timestamp
+    value |= 0x7 << 76  # version
+    value |= ((rand >> 62) & 0xFFF) << 64  # rand_a
+    value |= 0b10 << 62  # variant
+    value |= rand & ((1 << 62) - 1)  # rand_b
+    return str(uuid.UUID(int=value))
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    """Enable WAL and tuned PRAGMAs so readers don't block the chat writes"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-64000")  # 64 MB page cache
+    cursor.execute("PRAGMA mmap_size=268435456")  # 256 MB
+    cursor.close()
+
+def strict_loading(*options):
+    """Loader options for list queries; adds raiseload('*') in debug/testing
+    so accidental lazy loads (N+1) raise instead of silently querying"""
+    if current_app.debug or current_app.testing:
+        return (*options, raiseload('*'))
+    return options
+
 class User(db.Model):
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = db.Column(db.String(36), primary_key=True, default=uuid7)
     username = db.Column(db.String(80), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(128), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    conversations = db.relationship('Conversation', backref='user', lazy=True, cascade='all, delete-orphan')
+    conversations = db.relationship('Conversation', back_populates='user', lazy='select', cascade='all, delete-orphan')
 
 class Conversation(db.Model):
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    __table_args__ = (
+        db.Index('ix_conv_user_updated', 'user_id', 'updated_at'),  # Conversation list per user
+    )
+
+    id = db.Column(db.String(36), primary_key=True, default=uuid7)
     title = db.Column(db.String(200), nullable=False, default='New Conversation')
     user_id = db.Column(db.String(36), db.ForeignKey('user.id'), nullable=False)
     model_name = db.Column(db.String(50), nullable=False, default='qwen3:latest')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
-    messages = db.relationship('Message', backref='conversation', lazy=True, cascade='all, delete-orphan')
+    # Denormalized so the conversation list never has to count messages
+    message_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    user = db.relationship('User', back_populates='conversations', lazy='select')
+    messages = db.relationship('Message', back_populates='conversation', lazy='select', cascade='all, delete-orphan', order_by='Message.timestamp')
 
 class Message(db.Model):
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    __table_args__ = (
+        db.Index('ix_msg_conv_ts', 'conversation_id', 'timestamp'),  # History in order
+    )
+
+    id = db.Column(db.String(36), primary_key=True, default=uuid7)
     conversation_id = db.Column(db.String(36), db.ForeignKey('conversation.id'), nullable=False)
     role = db.Column(db.String(20), nullable=False)  # 'user' or 'assistant'
     content = db.Column(db.Text, nullable=False)
     audio_url = db.Column(db.String(255), nullable=True)  # Path to pre-generated audio file
+    audio_status = db.Column(db.String(20), nullable=True)  # 'pending', 'ready', 'failed'; None if no audio job
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    conversation = db.relationship('Conversation', back_populates='messages', lazy='select')
 
 class FineTuneData(db.Model):
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    __table_args__ = (
+        db.Index('ix_ftd_timestamp', 'timestamp'),  # Admin listing / export
+    )
+
+    id = db.Column(db.String(36), primary_key=True, default=uuid7)
     user_query = db.Column(db.Text, nullable=False)
     chosen_answer = db.Column(db.Text, nullable=False)
     model_used = db.Column(db.String(50), nullable=False)
     user_id = db.Column(db.String(36), db.ForeignKey('user.id'), nullable=False)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
\ No newline at end of file
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+def ensure_schema():
+    """Bring tables created by older versions up to date.
+
+    create_all() only creates missing tables, so add columns and indexes that
+    were introduced later.
+    """
+    inspector = inspect(db.engine)
+    conversation_columns = {column['name'] for column in inspector.get_columns('conversation')}
+    if 'message_count' not in conversation_columns:
+        with db.engine.begin() as connection:
+            connection.execute(text("ALTER TABLE conversation ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0"))
+            connection.execute(text(
+                "UPDATE conversation SET message_count = "
+                "(SELECT COUNT(*) FROM message WHERE message.conversation_id = conversation.id)"
+            ))
+
+    message_columns = {column['name'] for column in inspector.get_columns('message')}
+    if 'audio_status' not in message_columns:
+        with db.engine.begin() as connection:
+            connection.execute(text("ALTER TABLE message ADD COLUMN audio_status VARCHAR(20)"))
+            connection.execute(text("UPDATE message SET audio_status = 'ready' WHERE audio_url IS NOT NULL"))
+
+    created_index = False
+    for table in db.metadata.sorted_tables:
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(db.engine)
+                created_index = True
+
+    # Refresh planner statistics so the new indexes are picked up
+    if created_index:
+        with db.engine.begin() as connection:
+            connection.execute(text("ANALYZE"))
@@ -0,0 +1,39 @@
+"""Gunicorn configuration for production.
+
+Run with: gunicorn -c gunicorn.conf.py "app:create_app()"
+(`python app.py` starts the Flask development server instead.)
+"""
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:3030')
+
+# The app is mostly I/O bound (DB, Ollama HTTP, speech API), so use a few
+# processes with a thread pool each. With GUNICORN_WORKER_CLASS=gevent each
+# in-flight SSE stream is a greenlet instead of a thread, so concurrent chats
+# are no longer capped by `threads`. Prefer gevent for Ollama-only setups:
+# in-process Hugging Face generation is CPU/GPU bound and blocks the worker's
+# event loop while it runs.
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+workers = max(1, (os.cpu_count() or 2) // 2)
+threads = 6  # gthread only
+worker_connections = 1000  # gevent only
+
+# SSE responses can stream for as long as a model takes to generate
+timeout = 300
+
+
+def on_starting(server):
+    """Prefetch model weights once, from the master, rather than once per
+    worker; the forked workers wait on the same done event"""
+    from config import Config
+    if Config.PRELOAD_HF_MODELS:
+        from services.huggingface_service import start_weights_prefetch
+        start_weights_prefetch(Config.PRELOAD_HF_MODELS)
+
+
+def post_fork(server, worker):
+    """Pin each worker to one core to avoid cross-core GIL contention"""
+    if not hasattr(os, 'sched_setaffinity'):
+        return
+    cpu_count = os.cpu_count() or 1
+    os.sched_setaffinity(0, {worker.age % cpu_count})
@@ -1,12 +1,35 @@
-from flask import Blueprint, request, jsonify, Response
+from flask import Blueprint, request, jsonify, Response, stream_with_context
 from flask_jwt_extended import jwt_required, create_access_token, get_jwt
 from database import db, User, Conversation, Message, FineTuneData
+from sqlalchemy import select
 from datetime import datetime
+from functools import wraps
 import csv
 import io
 
 admin_bp = Blueprint('admin', __name__)
 
+def admin_required(fn):
+    """Require a valid JWT carrying the admin role"""
+    @wraps(fn)
+    @jwt_required()
+    def wrapper(*args, **kwargs):
+        if get_jwt().get('role') != 'admin':
+            return jsonify({'error': 'Admin access required'}), 403
+        return fn(*args, **kwargs)
+    return wrapper
+
+# Columns serialized by the fine-tune endpoints; selecting them directly returns
+# plain rows and skips ORM hydration
+FINE_TUNE_COLUMNS = (
+    FineTuneData.id,
+    FineTuneData.user_query,
+    FineTuneData.chosen_answer,
+    FineTuneData.model_used,
+    FineTuneData.user_id,
+    FineTuneData.timestamp
+)
+
 @admin_bp.route('/login', methods=['POST'])
 def admin_login():
     data = request.get_json()
@@ -21,13 +44,8 @@ def admin_login():
         return jsonify({'error': 'Invalid credentials'}), 401
 
 @admin_bp.route('/stats', methods=['GET'])
-@jwt_required()
+@admin_required
 def get_stats():
-    # Check if admin
-    claims = get_jwt()
-    if claims.get('role') != 'admin':
-        return jsonify({'error': 'Admin access required'}), 403
-
     user_count = User.query.count()
     conversation_count = Conversation.query.count()
     message_count = Message.query.count()
@@ -41,13 +59,11 @@ def get_stats():
     }), 200
 
 @admin_bp.route('/fine-tune-data', methods=['GET'])
-@jwt_required()
+@admin_required
 def get_fine_tune_data():
-    claims = get_jwt()
-    if claims.get('role') != 'admin':
-        return jsonify({'error': 'Admin access required'}), 403
-
-    data = FineTuneData.query.order_by(FineTuneData.timestamp.desc()).all()
+    data = db.session.execute(
+        select(*FINE_TUNE_COLUMNS).order_by(FineTuneData.timestamp.desc())
+    ).all()
     return jsonify([{
         'id': item.id,
         'user_query': item.user_query,
@@ -58,31 +74,40 @@ def get_fine_tune_data():
     } for item in data]), 200
 
 @admin_bp.route('/export-csv', methods=['GET'])
-@jwt_required()
+@admin_required
 def export_csv():
-    claims = get_jwt()
-    if claims.get('role') != 'admin':
-        return jsonify({'error': 'Admin access required'}), 403
+    query = (
+        select(*FINE_TUNE_COLUMNS)
+        .order_by(FineTuneData.timestamp.desc())
+        .execution_options(yield_per=1000)
+    )
 
-    data = FineTuneData.query.order_by(FineTuneData.timestamp.desc()).all()
+    def generate():
+        # Reuse one small buffer so rows are flushed to the client as they are
+        # read instead of building the whole CSV in memory
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(['ID', 'User Query', 'Chosen Answer', 'Model Used', 'User ID', 'Timestamp'])
 
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['ID', 'User Query', 'Chosen Answer', 'Model Used', 'User ID', 'Timestamp'])
+        for item in db.session.execute(query):
+            writer.writerow([
+                item.id,
+                item.user_query,
+                item.chosen_answer,
+                item.model_used,
+                item.user_id,
+                item.timestamp.isoformat()
+            ])
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate(0)
 
-    for item in data:
-        writer.writerow([
-            item.id,
-            item.user_query,
-            item.chosen_answer,
-            item.model_used,
-            item.user_id,
-            item.timestamp.isoformat()
-        ])
+        # Header only, when there are no rows
+        if output.tell():
+            yield output.getvalue()
 
-    output.seek(0)
     return Response(
-        output.getvalue(),
+        stream_with_context(generate()),
         mimetype='text/csv',
         headers={'Content-Disposition': 'attachment; filename=fine_tune_data.csv'}
     )
\ No newline at end of file
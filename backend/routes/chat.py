@@ -1,19 +1,52 @@
 from flask import Blueprint, request, jsonify, Response, stream_template, current_app, send_file
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from database import db, User, Conversation, Message, FineTuneData
+from database import db, User, Conversation, Message, FineTuneData, strict_loading
+from sqlalchemy import select, update
+from config import Config
 from services.ollama_service import create_ollama_service
 from services.huggingface_service import create_huggingface_service, HuggingFaceService
 from services.speech_service import create_speech_service
+from werkzeug.security import safe_join
 from datetime import datetime
-import json
+import orjson
 import os
+import shutil
 import tempfile
-import threading
+from concurrent.futures import ThreadPoolExecutor
 import queue
+import threading
 import time
+import logging
+
+logger = logging.getLogger(__name__)
 
 chat_bp = Blueprint('chat', __name__)
 
+def sse_event(payload: dict) -> bytes:
+    """Encode a payload as a server-sent event frame"""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+PARALLEL_DONE_EVENT = sse_event({'content': '', 'done': True, 'parallel': True})
+
+# Marks the end of one model's stream on the parallel-mode queue
+STREAM_DONE = object()
+
+# Shared workers for parallel-mode model streams. Reusing threads avoids
+# spawning two per request and bounds how many generations run at once
+PARALLEL_STREAM_WORKERS = 8
+parallel_stream_executor = ThreadPoolExecutor(max_workers=PARALLEL_STREAM_WORKERS, thread_name_prefix='parallel-stream')
+
+# Background workers for message TTS, which can take seconds per message
+TTS_WORKERS = 2
+# A job still pending after this long died with its worker process
+MESSAGE_AUDIO_TIMEOUT = 300  # seconds
+tts_executor = ThreadPoolExecutor(max_workers=TTS_WORKERS, thread_name_prefix='tts')
+
+UPLOAD_COPY_BUFFER = 1024 * 1024  # bytes
+# The ASR decoder needs a file path for webm uploads; keep those temp files
+# in memory-backed tmpfs where available instead of on disk
+AUDIO_TEMP_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
 def get_model_service(model_name: str):
     """Get the appropriate service for a model"""
     ollama_service = create_ollama_service()
@@ -26,19 +59,66 @@ def get_model_service(model_name: str):
     else:
         raise ValueError(f"Model {model_name} not available")
 
+def generate_message_audio_job(app, message_id: str, text: str):
+    """Generate TTS audio for a saved assistant message and store its URL"""
+    with app.app_context():
+        try:
+            speech_service = create_speech_service()
+            audio_url = speech_service.generate_message_audio(
+                message_id,
+                text,
+                language='tw',
+                speaker_id='twi_speaker_4'
+            )
+
+            if audio_url:
+                db.session.execute(update(Message).where(Message.id == message_id)
+                                   .values(audio_url=audio_url, audio_status='ready'))
+                db.session.commit()
+                return
+            logger.warning(f"TTS audio generation failed for message {message_id}, continuing without audio")
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"TTS audio job failed for message {message_id}: {str(e)}")
+        try:
+            db.session.execute(update(Message).where(Message.id == message_id).values(audio_status='failed'))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Could not mark audio failed for message {message_id}: {str(e)}")
+
+def send_wav(audio_path: str, as_attachment: bool, download_name: str = None):
+    """Send a wav file from disk; send_file uses wsgi.file_wrapper (sendfile)
+    and answers conditional and Range requests"""
+    return send_file(
+        audio_path,
+        mimetype='audio/wav',
+        as_attachment=as_attachment,
+        download_name=download_name,
+        conditional=True
+    )
+
+def get_user_conversation(conversation_id: str, user_id: str, options=()):
+    """Get a conversation by primary key if it belongs to the user, else None"""
+    # Primary key lookup goes through the session identity map first
+    conversation = db.session.get(Conversation, conversation_id, options=options)
+    if conversation is None or conversation.user_id != user_id:
+        return None
+    return conversation
+
 @chat_bp.route('/conversations', methods=['GET'])
 @jwt_required()
 def get_conversations():
     user_id = get_jwt_identity()
-    conversations = Conversation.query.filter_by(user_id=user_id).order_by(Conversation.updated_at.desc()).all()
-    
+    conversations = Conversation.query.options(*strict_loading()).filter_by(user_id=user_id).order_by(Conversation.updated_at.desc()).all()
+
     return jsonify([{
         "id": conv.id,
         "title": conv.title,
         "model_name": conv.model_name,
         "created_at": conv.created_at.isoformat(),
         "updated_at": conv.updated_at.isoformat(),
-        "message_count": len(conv.messages)
+        "message_count": conv.message_count
     } for conv in conversations])
 
 @chat_bp.route('/conversations', methods=['POST'])
@@ -71,12 +151,17 @@ def create_conversation():
 @jwt_required()
 def get_conversation(conversation_id):
     user_id = get_jwt_identity()
-    conversation = Conversation.query.filter_by(id=conversation_id, user_id=user_id).first()
+    conversation = get_user_conversation(conversation_id, user_id, options=strict_loading())
     
     if not conversation:
         return jsonify({"error": "Conversation not found"}), 404
     
-    messages = Message.query.filter_by(conversation_id=conversation_id).order_by(Message.timestamp.asc()).all()
+    # Plain rows of the serialized columns; no Message objects are hydrated
+    messages = db.session.execute(
+        select(Message.id, Message.role, Message.content, Message.audio_url, Message.timestamp)
+        .where(Message.conversation_id == conversation_id)
+        .order_by(Message.timestamp.asc())
+    ).all()
     
     return jsonify({
         "id": conversation.id,
@@ -92,11 +177,35 @@ def get_conversation(conversation_id):
         } for msg in messages]
     })
 
+@chat_bp.route('/messages/<message_id>/audio', methods=['GET'])
+@jwt_required()
+def get_message_audio(message_id):
+    """Get a message's pre-generated audio URL; 202 while it is still being
+    generated, 404 if the message has no audio or its synthesis failed"""
+    user_id = get_jwt_identity()
+    row = db.session.execute(
+        select(Message.audio_url, Message.audio_status, Message.timestamp)
+        .join(Conversation, Message.conversation_id == Conversation.id)
+        .where(Message.id == message_id, Conversation.user_id == user_id)
+    ).first()
+
+    if row is None:
+        return jsonify({"error": "Message not found"}), 404
+
+    if row.audio_url is not None:
+        return jsonify({"audio_url": row.audio_url, "audio_pending": False}), 200
+
+    if (row.audio_status == 'pending'
+            and (datetime.utcnow() - row.timestamp).total_seconds() < MESSAGE_AUDIO_TIMEOUT):
+        return jsonify({"audio_url": None, "audio_pending": True}), 202
+
+    return jsonify({"error": "No audio for this message", "audio_pending": False}), 404
+
 @chat_bp.route('/conversations/<conversation_id>/messages', methods=['POST'])
 @jwt_required()
 def send_message(conversation_id):
     user_id = get_jwt_identity()
-    conversation = Conversation.query.filter_by(id=conversation_id, user_id=user_id).first()
+    conversation = get_user_conversation(conversation_id, user_id)
 
     if not conversation:
         return jsonify({"error": "Conversation not found"}), 404
@@ -109,14 +218,14 @@ def send_message(conversation_id):
     if not message_content:
         return jsonify({"error": "Message cannot be empty"}), 400
 
-    # Save user message
+    # Timestamped now so it sorts before the reply; it is saved together
+    # with the reply once the response has been generated
     user_message = Message(
         conversation_id=conversation_id,
         role='user',
-        content=message_content
+        content=message_content,
+        timestamp=datetime.utcnow()
     )
-    db.session.add(user_message)
-    db.session.commit()
 
     # Store needed data
     model_name = conversation.model_name
@@ -125,140 +234,163 @@ def send_message(conversation_id):
     # Get model service to determine context handling
     model_service = get_model_service(model_name)
 
-    # Get conversation history
-    messages = Message.query.filter_by(conversation_id=conversation_id).order_by(Message.timestamp.asc()).all()
-    message_count = len(messages)
-
-    # Prepare messages based on service type
-    if isinstance(model_service, HuggingFaceService):
-        # For Hugging Face models, only send the last user message
-        ollama_messages = [{"role": "user", "content": message_content}]
-    else:
-        # For Ollama models, send full context
-        ollama_messages = []
-        for msg in messages:
-            ollama_messages.append({
-                "role": msg.role,
-                "content": msg.content
-            })
-
-    # Capture app object for context management in generator
+    # Including the new user message
+    message_count = conversation.message_count + 1
+
+    # Only the most recent messages are sent as model context, and only
+    # Ollama models use history at all. Select just role/content rows
+    # instead of hydrating Message objects.
+    context_messages = []
+    if parallel or not isinstance(model_service, HuggingFaceService):
+        history_limit = max(Config.CHAT_CONTEXT_WINDOW - 1, 0)
+        recent_messages = db.session.execute(
+            select(Message.role, Message.content)
+            .filter_by(conversation_id=conversation_id)
+            .order_by(Message.timestamp.desc())
+            .limit(history_limit)
+        ).all()
+        context_messages = recent_messages[::-1]
+    context_messages.append(user_message)
+
+    # Prepare both prompt shapes once; each model gets the one for its service
+    # For Hugging Face models, only send the last user message. The Twi
+    # models are single-turn, so each prompt is just this turn and there is
+    # no earlier-turn prefill (or KV cache) worth carrying across requests
+    hf_messages = [{"role": "user", "content": message_content}]
+    # For Ollama models, send the recent context window
+    context_dicts = [{"role": msg.role, "content": msg.content} for msg in context_messages]
+
+    def prepare_messages(service):
+        return hf_messages if isinstance(service, HuggingFaceService) else context_dicts
+
+    ollama_messages = prepare_messages(model_service)
+
+    # Capture app object for the generator's own app context and the
+    # background TTS job
     app = current_app._get_current_object()
 
-    def stream_to_queue(model_name, service, all_messages, current_message_content, q, model_index):
-        with app.app_context():
-            try:
-                # Prepare messages based on service type for this specific model
-                from services.huggingface_service import HuggingFaceService
-                if isinstance(service, HuggingFaceService):
-                    # For Hugging Face models, only send the last user message
-                    prepared_messages = [{"role": "user", "content": current_message_content}]
-                else:
-                    # For Ollama models, send full context
-                    prepared_messages = []
-                    for msg in all_messages:
-                        prepared_messages.append({
-                            "role": msg.role,
-                            "content": msg.content
-                        })
-
-                for chunk in service.chat_stream(model_name, prepared_messages):
-                    q.put({'content': chunk, 'model': model_name, 'model_index': model_index, 'done': False})
-                q.put({'done': True, 'model': model_name, 'model_index': model_index})
-            except Exception as e:
-                q.put({'error': str(e), 'model': model_name, 'model_index': model_index})
+    def stream_to_queue(model_name, service, prepared_messages, q, model_index, stop_event):
+        stream = service.chat_stream(model_name, prepared_messages)
+        try:
+            # Queue items are (model_index, item) tuples: item is a text
+            # chunk, STREAM_DONE when finished, or the raised exception
+            for chunk in stream:
+                if stop_event.is_set():
+                    break  # The response was abandoned or failed
+                q.put((model_index, chunk))
+            q.put((model_index, STREAM_DONE))
+        except Exception as e:
+            q.put((model_index, e))
+        finally:
+            # Stops the model's generation and frees this pool slot early
+            stream.close()
 
     # Generate streaming response
     def generate():
-        print(f"[DEBUG] Starting generate() for conversation {conversation_id}")
-        # Push application context for the generator
+        # The request's session is removed at teardown, before the body
+        # streams (discarding anything added or flushed there), so the turn
+        # is written in a fresh app context: one transaction for the user and
+        # assistant messages and the counter, and no write lock held while
+        # the model streams
         with app.app_context():
-            print("[DEBUG] App context pushed successfully")
-            try:
-                if parallel:
-                    # Parallel mode
-                    second_service = get_model_service(second_model)
-
-                    q = queue.Queue()
-                    t1 = threading.Thread(target=stream_to_queue, args=(model_name, model_service, messages, message_content, q, 0))
-                    t2 = threading.Thread(target=stream_to_queue, args=(second_model, second_service, messages, message_content, q, 1))
-                    t1.start()
-                    t2.start()
-
-                    responses = ['', '']
-                    done_count = 0
+            yield from generate_in_context()
 
+    def generate_in_context():
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug(f"Starting generate() for conversation {conversation_id}")
+        try:
+            if parallel:
+                # Parallel mode
+                second_service = get_model_service(second_model)
+
+                q = queue.Queue()
+                # Set when this response ends early (client gone, or an arm
+                # failed) so the other arm stops generating
+                stop_event = threading.Event()
+                parallel_stream_executor.submit(stream_to_queue, model_name, model_service, ollama_messages, q, 0, stop_event)
+                parallel_stream_executor.submit(stream_to_queue, second_model, second_service, prepare_messages(second_service), q, 1, stop_event)
+
+                model_names = (model_name, second_model)
+                responses = [[], []]
+                done_count = 0
+
+                try:
                     while done_count < 2:
-                        item = q.get()
-                        if 'error' in item:
-                            yield f"data: {json.dumps({'error': item['error'], 'done': True})}\n\n"
-                            return
-                        if item['done']:
+                        model_index, item = q.get()
+                        if item is STREAM_DONE:
                             done_count += 1
                             continue
-                        responses[item['model_index']] += item['content']
-                        yield f"data: {json.dumps({'content': item['content'], 'model': item['model'], 'model_index': item['model_index'], 'done': False})}\n\n"
-
-                    # For parallel, don't save yet, wait for choice
-                    yield f"data: {json.dumps({'content': '', 'done': True, 'parallel': True})}\n\n"
-                else:
-                    # Single mode
-                    assistant_response = ""
-                    chunk_count = 0
-
-                    print(f"[DEBUG] Starting stream for model {model_name}")
-                    for chunk in model_service.chat_stream(model_name, ollama_messages):
-                        assistant_response += chunk
-                        chunk_count += 1
-                        if chunk_count % 10 == 0:  # Log every 10 chunks
-                            print(f"[DEBUG] Processed {chunk_count} chunks, current response length: {len(assistant_response)}")
-                        yield f"data: {json.dumps({'content': chunk, 'done': False})}\n\n"
-
-                    print(f"[DEBUG] Stream completed, total chunks: {chunk_count}, response length: {len(assistant_response)}")
-
-                    # Save assistant response
-                    print("[DEBUG] Saving assistant message to database")
-                    assistant_message = Message(
-                        conversation_id=conversation_id,
-                        role='assistant',
-                        content=assistant_response
-                    )
-                    db.session.add(assistant_message)
-                    db.session.flush()  # Get the message ID without committing
-
-                    # Generate TTS audio for assistant messages
-                    print(f"[DEBUG] Generating TTS audio for message {assistant_message.id}")
-                    speech_service = create_speech_service()
-                    audio_url = speech_service.generate_message_audio(
-                        assistant_message.id,
-                        assistant_response,
-                        language='tw',
-                        speaker_id='twi_speaker_4'
-                    )
-
-                    if audio_url:
-                        assistant_message.audio_url = audio_url
-                        print(f"[DEBUG] TTS audio generated: {audio_url}")
-                    else:
-                        print("[DEBUG] TTS audio generation failed, continuing without audio")
-
-                    # Update conversation title if it's the first message
-                    if conversation_title == 'New Conversation' and message_count == 1:
-                        print("[DEBUG] Updating conversation title")
-                        conv_to_update = Conversation.query.filter_by(id=conversation_id).first()
-                        if conv_to_update:
-                            conv_to_update.title = message_content[:50] + "..." if len(message_content) > 50 else message_content
-                            conv_to_update.updated_at = datetime.utcnow()
-
-                    db.session.commit()
-                    print(f"[DEBUG] Database commit successful, message_id: {assistant_message.id}")
-
-                    yield f"data: {json.dumps({'content': '', 'done': True, 'message_id': assistant_message.id})}\n\n"
-
-            except Exception as e:
-                print(f"[ERROR] Exception in generate(): {str(e)}")
-                db.session.rollback()
-                yield f"data: {json.dumps({'error': str(e), 'done': True})}\n\n"
+                        if isinstance(item, Exception):
+                            yield sse_event({'error': str(item), 'done': True})
+                            return
+                        responses[model_index].append(item)
+                        yield sse_event({'content': item, 'model': model_names[model_index], 'model_index': model_index, 'done': False})
+                finally:
+                    stop_event.set()
+
+                # For parallel, only the user message is saved; the chosen
+                # answer is stored via select_response
+                db.session.add(user_message)
+                db.session.execute(
+                    update(Conversation)
+                    .where(Conversation.id == conversation_id)
+                    .values(message_count=Conversation.message_count + 1)
+                )
+                db.session.commit()
+                yield PARALLEL_DONE_EVENT
+            else:
+                # Single mode
+                response_parts = []
+
+                if debug:
+                    logger.debug(f"Starting stream for model {model_name}")
+                for chunk in model_service.chat_stream(model_name, ollama_messages):
+                    response_parts.append(chunk)
+                    yield sse_event({'content': chunk, 'done': False})
+                assistant_response = ''.join(response_parts)
+
+                if debug:
+                    logger.debug(f"Stream completed, response length: {len(assistant_response)}")
+
+                # Save user message and assistant response
+                db.session.add(user_message)
+                assistant_message = Message(
+                    conversation_id=conversation_id,
+                    role='assistant',
+                    content=assistant_response,
+                    audio_status='pending'
+                )
+                db.session.add(assistant_message)
+                db.session.flush()  # Get the message ID without committing
+                assistant_message_id = assistant_message.id
+
+                # The request's conversation object is detached here, so
+                # update the row in this session. User + assistant message
+                conversation_values = {'message_count': Conversation.message_count + 2}
+                # Update conversation title if it's the first message
+                if conversation_title == 'New Conversation' and message_count == 1:
+                    conversation_values['title'] = message_content[:50] + "..." if len(message_content) > 50 else message_content
+                    conversation_values['updated_at'] = datetime.utcnow()
+                db.session.execute(
+                    update(Conversation)
+                    .where(Conversation.id == conversation_id)
+                    .values(**conversation_values)
+                )
+                db.session.commit()
+                if debug:
+                    logger.debug(f"Database commit successful, message_id: {assistant_message_id}")
+
+                # Generate TTS audio in the background so the stream can finish
+                # now; audio_url is filled in once it is ready
+                tts_executor.submit(generate_message_audio_job, app, assistant_message_id, assistant_response)
+
+                yield sse_event({'content': '', 'done': True, 'message_id': assistant_message_id, 'audio_pending': True})
+
+        except Exception as e:
+            logger.error(f"Exception in generate(): {str(e)}")
+            db.session.rollback()
+            yield sse_event({'error': str(e), 'done': True})
 
     return Response(generate(), mimetype='text/event-stream',
                    headers={'Cache-Control': 'no-cache',
@@ -269,7 +401,7 @@ def send_message(conversation_id):
 @jwt_required()
 def delete_conversation(conversation_id):
     user_id = get_jwt_identity()
-    conversation = Conversation.query.filter_by(id=conversation_id, user_id=user_id).first()
+    conversation = get_user_conversation(conversation_id, user_id)
     
     if not conversation:
         return jsonify({"error": "Conversation not found"}), 404
@@ -291,9 +423,9 @@ def transcribe_audio():
         if audio_file.filename == '':
             return jsonify({"error": "No audio file selected"}), 400
 
-        # Save uploaded file temporarily
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.webm') as temp_file:
-            audio_file.save(temp_file.name)
+        # Save uploaded file temporarily, copying in 1 MB chunks
+        with tempfile.NamedTemporaryFile(delete=False, suffix='.webm', dir=AUDIO_TEMP_DIR, buffering=UPLOAD_COPY_BUFFER) as temp_file:
+            shutil.copyfileobj(audio_file.stream, temp_file, length=UPLOAD_COPY_BUFFER)
             temp_path = temp_file.name
 
         try:
@@ -316,7 +448,7 @@ def transcribe_audio():
 @jwt_required()
 def select_response(conversation_id):
     user_id = get_jwt_identity()
-    conversation = Conversation.query.filter_by(id=conversation_id, user_id=user_id).first()
+    conversation = get_user_conversation(conversation_id, user_id)
 
     if not conversation:
         return jsonify({"error": "Conversation not found"}), 404
@@ -358,40 +490,35 @@ def synthesize_text():
         speech_service = create_speech_service()
         audio_path = speech_service.synthesize_text(text, language, speaker_id)
 
-        # Check if file exists and has content
-        if not os.path.exists(audio_path):
-            return jsonify({"error": "Audio file was not created"}), 500
+        # Check if file exists and has content (one stat call). A cached clip
+        # can be gone (evicted by another worker process, or removed by hand):
+        # drop it from the cache index and synthesize it again
+        try:
+            file_size = os.stat(audio_path).st_size
+        except FileNotFoundError:
+            speech_service.discard_cached_audio(audio_path)
+            audio_path = speech_service.synthesize_text(text, language, speaker_id)
+            try:
+                file_size = os.stat(audio_path).st_size
+            except FileNotFoundError:
+                return jsonify({"error": "Audio file was not created"}), 500
 
-        file_size = os.path.getsize(audio_path)
         if file_size == 0:
             return jsonify({"error": "Audio file is empty"}), 500
 
-        # Read the audio file and return as response
-        with open(audio_path, 'rb') as audio_file:
-            audio_data = audio_file.read()
-
-        # Return audio data directly
-        response = current_app.response_class(
-            audio_data,
-            mimetype='audio/wav',
-            headers={
-                'Content-Disposition': 'attachment; filename=speech.wav',
-                'Content-Length': str(len(audio_data))
-            }
-        )
-        return response
+        # The file is a persistent TTS cache entry, so it is not cleaned up
+        # after the response
+        return send_wav(audio_path, as_attachment=True, download_name='speech.wav')
 
     except Exception as e:
-        print(f"[TTS] Error: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"TTS error: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
 @chat_bp.route('/conversations/<conversation_id>/model', methods=['PUT'])
 @jwt_required()
 def change_conversation_model(conversation_id):
     user_id = get_jwt_identity()
-    conversation = Conversation.query.filter_by(id=conversation_id, user_id=user_id).first()
+    conversation = get_user_conversation(conversation_id, user_id)
 
     if not conversation:
         return jsonify({"error": "Conversation not found"}), 404
@@ -403,9 +530,7 @@ def change_conversation_model(conversation_id):
         return jsonify({"error": "Model name is required"}), 400
 
     # Verify model is available in either service
-    try:
-        model_service = get_model_service(new_model)
-    except ValueError:
+    if not create_ollama_service().is_model_available(new_model) and not create_huggingface_service().is_model_available(new_model):
         return jsonify({"error": f"Model {new_model} is not available"}), 400
 
     conversation.model_name = new_model
@@ -418,18 +543,14 @@ def change_conversation_model(conversation_id):
 def serve_audio(filename):
     """Serve pre-generated audio files for messages"""
     try:
-        from services.speech_service import create_speech_service
         speech_service = create_speech_service()
-        audio_path = os.path.join(speech_service.audio_dir, filename)
+        # safe_join rejects filenames that would escape the audio directory
+        audio_path = safe_join(speech_service.audio_dir, filename)
 
-        if not os.path.exists(audio_path):
+        if audio_path is None or not os.path.isfile(audio_path):
             return jsonify({"error": "Audio file not found"}), 404
 
-        return send_file(
-            audio_path,
-            mimetype='audio/wav',
-            as_attachment=False  # Allow direct playback in browser
-        )
+        return send_wav(audio_path, as_attachment=False)  # Allow direct playback in browser
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
\ No newline at end of file
@@ -5,28 +5,28 @@ from services.huggingface_service import create_huggingface_service
 
 models_bp = Blueprint('models', __name__)
 
-@models_bp.route('/models', methods=['GET'])
-@jwt_required()
-def get_available_models():
-    ollama_service = create_ollama_service()
-    huggingface_service = create_huggingface_service()
-
-    ollama_models = ollama_service.get_available_models()
-    hf_models = huggingface_service.get_available_models()
+def get_merged_models() -> list:
+    """Get the combined Ollama + Hugging Face model list. Both come from
+    memory: the Ollama list is the service's MODELS_TTL-cached copy"""
+    ollama_models = create_ollama_service().get_available_models()
+    hf_models = create_huggingface_service().get_available_models()
 
     # Combine models from both services
     all_models = {**ollama_models, **hf_models}
 
-    return jsonify({
-        "models": [
-            {
-                "name": model_data["name"],
-                "size": model_data["size"],
-                "modified_at": model_data["modified_at"]
-            }
-            for model_data in all_models.values()
-        ]
-    })
+    return [
+        {
+            "name": model_data["name"],
+            "size": model_data["size"],
+            "modified_at": model_data["modified_at"]
+        }
+        for model_data in all_models.values()
+    ]
+
+@models_bp.route('/models', methods=['GET'])
+@jwt_required()
+def get_available_models():
+    return jsonify({"models": get_merged_models()})
 
 @models_bp.route('/models/<model_name>/pull', methods=['POST'])
 @jwt_required()
@@ -38,6 +38,7 @@ def pull_model(model_name):
     if ollama_service.is_model_available(model_name):
         success = ollama_service.pull_model(model_name)
         if success:
+            # pull_model marks the Ollama list stale, so the next request lists it
             return jsonify({"message": f"Model {model_name} pulled successfully"}), 200
         else:
             return jsonify({"error": f"Failed to pull model {model_name}"}), 500
@@ -1,12 +1,25 @@
 import bcrypt
+import os
 from flask_jwt_extended import create_access_token
 from database import db, User
+from config import Config
+
+# Hash checked for unknown usernames, created on first use
+_cached_dummy_hash = None
 
 class AuthService:
     @staticmethod
     def hash_password(password: str) -> str:
         """Hash a password"""
-        return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=Config.BCRYPT_ROUNDS)).decode('utf-8')
+    
+    @staticmethod
+    def _dummy_password_hash() -> str:
+        """Get a throwaway hash with the configured cost for unknown users"""
+        global _cached_dummy_hash
+        if _cached_dummy_hash is None:
+            _cached_dummy_hash = AuthService.hash_password(os.urandom(16).hex())
+        return _cached_dummy_hash
     
     @staticmethod
     def verify_password(password: str, password_hash: str) -> bool:
@@ -43,7 +56,10 @@ class AuthService:
         """Login a user"""
         user = User.query.filter_by(username=username).first()
         
-        if not user or not AuthService.verify_password(password, user.password_hash):
+        # Always run one bcrypt check so unknown usernames take as long as
+        # wrong passwords (no timing-based user enumeration)
+        password_hash = user.password_hash if user else AuthService._dummy_password_hash()
+        if not AuthService.verify_password(password, password_hash) or not user:
             return {"error": "Invalid credentials"}
         
         token = create_access_token(identity=user.id)
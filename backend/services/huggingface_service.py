@@ -1,18 +1,77 @@
-from transformers import AutoTokenizer, AutoModelForCausalLM
-from peft import PeftModel
-import torch
-from typing import Generator, Dict, Any, List
+import os
+# Let the CUDA caching allocator grow segments instead of fragmenting when
+# several models are moved to the GPU concurrently during preload; read on
+# first CUDA use, so it must be set before any model is loaded
+os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True')
+
+# torch/transformers/peft are imported inside the methods that use them, so
+# importing this module (routes, the prefetch process) stays cheap until a
+# model is actually loaded
+from config import Config
+from typing import Generator, Dict, Any, Iterable, List
 import threading
-import time
+import multiprocessing
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
+# Global service instance cache
+_huggingface_service_instance = None
+# Set when the weights prefetch process finishes; None if none was started.
+# Under gunicorn the master starts it before forking, so workers inherit it
+_weights_prefetched = None
+
+# Prompt turn labels; the model starting a new turn means the reply is over
+ASSISTANT_MARKER = "Assistant:"
+TURN_MARKERS = (ASSISTANT_MARKER, "User:", "System:")
+
+MAX_NEW_TOKENS = 100
+# Files from_pretrained reads: configs, safetensors weights (adapters may only
+# ship a .bin) and tokenizer files. Skips duplicate .bin/.h5/.msgpack weights
+PREFETCH_PATTERNS = ["*.json", "*.safetensors", "adapter_model.bin", "tokenizer*", "*.model", "merges.txt"]
+# Length of the preallocated KV cache used for compiled models; prompts that
+# would not fit fall back to the dynamic cache
+STATIC_CACHE_LEN = 512
+
+class StopOnEvent:
+    """Stopping criterion (duck-typed transformers StoppingCriteria) that
+    stops generation once the consumer of the stream is done with it"""
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        return self.event.is_set()
+
+class StopOnReplyEnd:
+    """Stopping criterion that ends generation at the first full stop or new
+    turn marker, mirroring where _filter_assistant_stream cuts the reply"""
+    def __init__(self, tokenizer, prompt_length: int):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        # Replies are capped at max_new_tokens, so decoding the whole reply
+        # each step stays cheap and handles markers split across tokens
+        text = self.tokenizer.decode(input_ids[0, self.prompt_length:], skip_special_tokens=True).lstrip()
+        if text.startswith(ASSISTANT_MARKER):
+            text = text[len(ASSISTANT_MARKER):]
+        return "." in text or any(marker in text for marker in TURN_MARKERS)
+
 class HuggingFaceService:
     def __init__(self):
         self.models = {}
         self.loading_status = {}  # Track loading status: 'not_started', 'loading', 'loaded', 'failed'
         self._load_available_models()
+        # The instance is shared across request threads; one lock per model so
+        # different models can load concurrently
+        self._load_locks = {model_name: threading.Lock() for model_name in self.models}
+        # A model's static KV cache is reused across calls, so generations
+        # that use it take turns
+        self._static_caches = {}
+        self._generate_locks = {model_name: threading.Lock() for model_name in self.models}
+        # Checked on first use of the quantized KV cache
+        self._kv_cache_backend_ok = None
 
     def _load_available_models(self):
         """Load predefined Hugging Face models"""
@@ -43,18 +102,21 @@ class HuggingFaceService:
 
     def preload_models(self, model_names: List[str]):
         """Pre-load specified models in background"""
+        def load_one(model_name):
+            if model_name not in self.models:
+                logger.warning(f"Model {model_name} not available for pre-loading")
+                return
+            try:
+                logger.info(f"Pre-loading model: {model_name}")
+                self._load_model(model_name)
+            except Exception as e:
+                logger.error(f"Failed to pre-load model {model_name}: {str(e)}")
+
         def load_worker():
-            for model_name in model_names:
-                if model_name in self.models:
-                    try:
-                        logger.info(f"Pre-loading model: {model_name}")
-                        self._load_model(model_name)
-                        # Small delay between loads to prevent memory spikes
-                        time.sleep(2)
-                    except Exception as e:
-                        logger.error(f"Failed to pre-load model {model_name}: {str(e)}")
-                else:
-                    logger.warning(f"Model {model_name} not available for pre-loading")
+            # Load in parallel; low_cpu_mem_usage keeps peak RAM per model near
+            # its weight size, and weight I/O and GPU copies release the GIL
+            with ThreadPoolExecutor(max_workers=max(len(model_names), 1)) as executor:
+                list(executor.map(load_one, model_names))
 
         # Start background loading thread
         loading_thread = threading.Thread(target=load_worker, daemon=True)
@@ -65,29 +127,101 @@ class HuggingFaceService:
         """Get loading status for all models"""
         return self.loading_status.copy()
 
+    def _model_load_kwargs(self) -> Dict[str, Any]:
+        """from_pretrained kwargs: low-memory loading, half precision on GPU
+        (and on CPUs with native BF16), plus optional bitsandbytes quantization
+        (Config.HF_QUANTIZATION)"""
+        import torch
+
+        # Load safetensors weights straight into place (mmap) instead of
+        # building a randomly initialized model first
+        load_kwargs = {'low_cpu_mem_usage': True}
+        if not torch.cuda.is_available():
+            # BF16 only pays off with hardware support (AVX512-BF16/AMX);
+            # emulated BF16 matmuls are slower than FP32
+            cpu_bf16 = getattr(torch.cpu, '_is_avx512_bf16_supported', None)
+            if cpu_bf16 is not None and cpu_bf16():
+                load_kwargs['torch_dtype'] = torch.bfloat16
+            return load_kwargs
+
+        # Any matmuls still in FP32 (e.g. upcast logits) may use TF32 tensor
+        # cores; attention already goes through SDPA's flash/mem-efficient kernels
+        torch.set_float32_matmul_precision('high')
+        torch.backends.cudnn.allow_tf32 = True
+
+        dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        load_kwargs['torch_dtype'] = dtype
+
+        if Config.HF_QUANTIZATION in ('4bit', '8bit'):
+            # Requires the optional bitsandbytes package
+            from transformers import BitsAndBytesConfig
+            if Config.HF_QUANTIZATION == '4bit':
+                quantization_config = BitsAndBytesConfig(
+                    load_in_4bit=True,
+                    bnb_4bit_compute_dtype=dtype,
+                    bnb_4bit_quant_type='nf4'
+                )
+            else:
+                quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+            load_kwargs['quantization_config'] = quantization_config
+            load_kwargs['device_map'] = 'auto'
+
+        return load_kwargs
+
     def _load_model(self, model_name: str):
         """Lazy load model and tokenizer"""
         if model_name not in self.models:
             raise ValueError(f"Model {model_name} not available")
 
-        if self.models[model_name]['model'] is None:
+        if self.models[model_name]['model'] is not None:
+            return
+
+        with self._load_locks[model_name]:
+            # Another request may have finished loading while we waited
+            if self.models[model_name]['model'] is not None:
+                return
+
             self.loading_status[model_name] = 'loading'
             try:
+                import torch
+                from transformers import AutoTokenizer, AutoModelForCausalLM
+                from peft import PeftModel
+
                 logger.info(f"Loading Hugging Face model: {model_name}")
-                self.models[model_name]['tokenizer'] = AutoTokenizer.from_pretrained(model_name)
+                # Tokenize with the Rust tokenizers backend; the slow Python
+                # tokenizer would put BPE merges on every request's hot path
+                tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+                if not tokenizer.is_fast:
+                    logger.warning(f"No fast tokenizer for {model_name}, using the slow Python tokenizer")
+                self.models[model_name]['tokenizer'] = tokenizer
+
+                load_kwargs = self._model_load_kwargs()
 
                 # Check if this is a PEFT model
                 if 'peft_base' in self.models[model_name]:
                     base_model_name = self.models[model_name]['peft_base']
                     logger.info(f"Loading PEFT model with base: {base_model_name}")
-                    base_model = AutoModelForCausalLM.from_pretrained(base_model_name)
-                    self.models[model_name]['model'] = PeftModel.from_pretrained(base_model, model_name)
+                    base_model = AutoModelForCausalLM.from_pretrained(base_model_name, **load_kwargs)
+                    model = PeftModel.from_pretrained(base_model, model_name)
+                    if 'quantization_config' not in load_kwargs:
+                        # Fold the LoRA deltas into the base weights so forward
+                        # passes skip the per-layer adapter matmuls
+                        model = model.merge_and_unload()
                 else:
-                    self.models[model_name]['model'] = AutoModelForCausalLM.from_pretrained(model_name)
+                    model = AutoModelForCausalLM.from_pretrained(model_name, **load_kwargs)
+
+                # Move to GPU if available (quantized models are placed by device_map)
+                if torch.cuda.is_available() and 'device_map' not in load_kwargs:
+                    model = model.cuda()
+
+                if Config.TORCH_COMPILE:
+                    # Under the load lock, so concurrent first requests can't
+                    # each allocate a cache
+                    self._create_static_cache(model_name, model)
+                    self._compile_model(model_name, model, self.models[model_name]['tokenizer'])
 
-                # Move to GPU if available
-                if torch.cuda.is_available():
-                    self.models[model_name]['model'] = self.models[model_name]['model'].cuda()
+                # Publish only the fully prepared model to the lock-free check above
+                self.models[model_name]['model'] = model
 
                 self.loading_status[model_name] = 'loaded'
                 logger.info(f"Successfully loaded model: {model_name}")
@@ -96,85 +230,233 @@ class HuggingFaceService:
                 logger.error(f"Failed to load model {model_name}: {str(e)}")
                 raise
 
-    def _filter_assistant_response(self, response: str) -> str:
-        """Filter response to extract only the first Assistant response and avoid repetitions"""
-        # Find the first "Assistant:" occurrence
-        assistant_start = response.find("Assistant:")
-        if assistant_start == -1:
-            return response.strip()
+    def _compile_model(self, model_name: str, model, tokenizer):
+        """Compile the model's forward pass and warm it up so the first real
+        request does not pay the compile cost; falls back to eager on failure"""
+        import torch
 
-        # Extract from "Assistant:" onwards
-        assistant_response = response[assistant_start + len("Assistant:"):].strip()
-
-        # Find the next "Assistant:" to cut off repetitions
-        next_assistant = assistant_response.find("Assistant:")
-        if next_assistant != -1:
-            assistant_response = assistant_response[:next_assistant].strip()
-
-        # Cut at the first full stop (period) for concise responses
-        first_period = assistant_response.find(".")
-        if first_period != -1:
-            assistant_response = assistant_response[:first_period + 1].strip()
-
-        return assistant_response
+        if not hasattr(torch, 'compile'):
+            return
+        eager_forward = model.forward
+        try:
+            # Compile forward rather than wrapping the module, so generate()
+            # (which calls self.forward) actually runs the compiled graph
+            # No CUDA graphs ("reduce-overhead"): they are thread-local and
+            # generate runs on many request/worker threads
+            model.forward = torch.compile(eager_forward, mode="default", fullgraph=False)
+            warmup_inputs = tokenizer("Assistant: ", return_tensors="pt").to(model.device)
+            self._generate(model_name, model, **warmup_inputs, max_new_tokens=1,
+                           pad_token_id=tokenizer.eos_token_id,
+                           **self._cache_kwargs(model_name, model, warmup_inputs['input_ids'].shape[1] + 1))
+        except Exception as e:
+            model.forward = eager_forward
+            logger.warning(f"torch.compile failed, using eager mode: {str(e)}")
+
+    def _cache_kwargs(self, model_name: str, model, max_length: int) -> Dict[str, Any]:
+        """generate() kwargs selecting the KV cache: quantized when
+        Config.HF_KV_CACHE_BITS is set, otherwise the model's preallocated
+        static cache when it is compiled (dynamic cache shapes force recompilation)"""
+        if Config.HF_KV_CACHE_BITS and self._kv_cache_backend_available():
+            return {
+                'cache_implementation': 'quantized',
+                'cache_config': {'backend': Config.HF_KV_CACHE_BACKEND, 'nbits': Config.HF_KV_CACHE_BITS}
+            }
+        static_cache = self._static_caches.get(model_name)
+        if static_cache is not None and max_length <= STATIC_CACHE_LEN:
+            return {'past_key_values': static_cache}
+        return {}
+
+    def _create_static_cache(self, model_name: str, model):
+        """Allocate the model's static KV cache at load time (called under its
+        load lock); skipped when the quantized cache is used instead"""
+        # _can_compile_fullgraph is transformers' marker for models whose
+        # attention supports a static cache
+        if not getattr(model, '_can_compile_fullgraph', False):
+            return
+        if Config.HF_KV_CACHE_BITS and self._kv_cache_backend_available():
+            return
+        try:
+            from transformers import StaticCache
+            # Allocated once per model with a fixed length, so every call
+            # reuses the same buffers and compiled graph shapes; the
+            # layers take device/dtype from the first update
+            self._static_caches[model_name] = StaticCache(
+                config=model.config,
+                max_cache_len=STATIC_CACHE_LEN
+            )
+        except Exception as e:
+            logger.warning(f"Static KV cache unavailable for {model_name}, "
+                           f"using dynamic cache: {str(e)}")
+
+    def _kv_cache_backend_available(self) -> bool:
+        """Whether the package for Config.HF_KV_CACHE_BACKEND is installed;
+        warns once and disables the quantized cache if it is not"""
+        if self._kv_cache_backend_ok is None:
+            from transformers.utils import is_hqq_available, is_optimum_quanto_available
+            checks = {'quanto': is_optimum_quanto_available, 'hqq': is_hqq_available}
+            backend = Config.HF_KV_CACHE_BACKEND
+            if backend not in checks:
+                logger.warning(f"Unknown HF_KV_CACHE_BACKEND '{backend}' (use 'quanto' or 'hqq'), "
+                               f"KV cache quantization disabled")
+                self._kv_cache_backend_ok = False
+            elif not checks[backend]():
+                package = 'optimum-quanto' if backend == 'quanto' else 'hqq'
+                logger.warning(f"HF_KV_CACHE_BITS is set but {package} is not installed, "
+                               f"KV cache quantization disabled")
+                self._kv_cache_backend_ok = False
+            else:
+                self._kv_cache_backend_ok = True
+        return self._kv_cache_backend_ok
+
+    def _generate(self, model_name: str, model, **generate_kwargs):
+        """Run model.generate, serializing calls that share the static KV cache"""
+        import torch
+
+        cache = generate_kwargs.get('past_key_values')
+        with torch.inference_mode():
+            if cache is None:
+                return model.generate(**generate_kwargs)
+            with self._generate_locks[model_name]:
+                cache.reset()
+                return model.generate(**generate_kwargs)
+
+    def _filter_assistant_stream(self, chunks: Iterable[str]) -> Generator[str, None, None]:
+        """Yield only the first Assistant response from streamed text, cutting off
+        repetitions (a new turn marker) and stopping at the first full stop"""
+        # Hold back enough text to recognize a marker split across chunks
+        holdback = max(len(marker) for marker in TURN_MARKERS) - 1
+        buffer = ""
+        started = False
+
+        for chunk in chunks:
+            buffer += chunk
+            if not started:
+                # Skip leading whitespace and a repeated "Assistant:" label
+                buffer = buffer.lstrip()
+                if ASSISTANT_MARKER.startswith(buffer):
+                    continue
+                if buffer.startswith(ASSISTANT_MARKER):
+                    buffer = buffer[len(ASSISTANT_MARKER):].lstrip()
+                    if not buffer:
+                        continue
+                started = True
+
+            finished = False
+            cuts = [index for index in (buffer.find(marker) for marker in TURN_MARKERS) if index != -1]
+            if cuts:
+                buffer = buffer[:min(cuts)]
+                finished = True
+
+            # Cut at the first full stop (period) for concise responses
+            first_period = buffer.find(".")
+            if first_period != -1:
+                buffer = buffer[:first_period + 1]
+                finished = True
+
+            if finished:
+                buffer = buffer.rstrip()
+                if buffer:
+                    yield buffer
+                return
+
+            if len(buffer) > holdback:
+                yield buffer[:-holdback]
+                buffer = buffer[-holdback:]
+
+        buffer = buffer.rstrip()
+        if buffer:
+            yield buffer
+
+    def _build_inputs(self, tokenizer, messages: List[Dict[str, str]],
+                      system_message: str = None) -> Dict[str, Any]:
+        """Tokenize the prompt into input_ids/attention_mask tensors"""
+        if system_message:
+            messages = [{"role": "system", "content": system_message}] + messages
+
+        # Use the model's own chat template when it ships one
+        if tokenizer.chat_template:
+            return tokenizer.apply_chat_template(
+                messages,
+                add_generation_prompt=True,
+                return_tensors="pt",
+                return_dict=True
+            )
+
+        # Otherwise fall back to the plain "Role: content" format the Twi
+        # models were fine-tuned on
+        conversation = "".join(f"{msg['role'].capitalize()}: {msg['content']}\n" for msg in messages)
+        conversation += "Assistant: "
+        return tokenizer(conversation, return_tensors="pt")
 
     def chat_stream(self, model: str, messages: List[Dict[str, str]],
-                   system_message: str = None) -> Generator[str, None, None]:
-        """Stream chat completion from Hugging Face model"""
+                   system_message: str = None, max_new_tokens: int = MAX_NEW_TOKENS,
+                   do_sample: bool = True) -> Generator[str, None, None]:
+        """Stream chat completion from Hugging Face model (do_sample=False
+        decodes greedily)"""
         try:
             self._load_model(model)
+            from transformers import TextIteratorStreamer, StoppingCriteriaList
+
             tokenizer = self.models[model]['tokenizer']
             model_obj = self.models[model]['model']
 
-            # Prepare input text
-            conversation = ""
-            if system_message:
-                conversation += f"System: {system_message}\n"
-
-            for msg in messages:
-                role = msg["role"]
-                content = msg["content"]
-                conversation += f"{role.capitalize()}: {content}\n"
-
-            conversation += "Assistant: "
-
-            # Tokenize input
-            inputs = tokenizer(conversation, return_tensors="pt")
-            if torch.cuda.is_available():
-                inputs = {k: v.cuda() for k, v in inputs.items()}
-
-            # Generate response
-            with torch.no_grad():
-                output = model_obj.generate(
-                    **inputs,
-                    max_new_tokens=100,  # Adjust as needed
-                    temperature=0.7,
-                    top_p=0.9,
-                    do_sample=True,
-                    pad_token_id=tokenizer.eos_token_id
-                )
-
-            # Decode the full response
-            full_response = tokenizer.decode(output[0], skip_special_tokens=True)
-
-            # Extract only the new part (after the input)
-            new_response = full_response[len(conversation):].strip()
+            inputs = self._build_inputs(tokenizer, messages, system_message)
+            if model_obj.device.type == 'cuda':
+                # Copy from pinned memory asynchronously; generate() runs on the
+                # same stream, so its kernels are ordered after the copy
+                inputs = {k: v.pin_memory().to(model_obj.device, non_blocking=True) for k, v in inputs.items()}
+            else:
+                inputs = inputs.to(model_obj.device)
+
+            # Generate in a background thread and yield text as tokens are produced
+            streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+            # Set when the filter has its answer (or the client went away) so
+            # the background generate stops instead of running to max_new_tokens
+            stop_event = threading.Event()
+            generation_errors = []
+
+            sampling_kwargs = {'do_sample': True, 'temperature': 0.7, 'top_p': 0.9} if do_sample else {'do_sample': False}
+
+            def run_generate():
+                try:
+                    prompt_length = inputs['input_ids'].shape[1]
+                    self._generate(
+                        model, model_obj,
+                        **inputs,
+                        streamer=streamer,
+                        max_new_tokens=max_new_tokens,
+                        **sampling_kwargs,
+                        pad_token_id=tokenizer.eos_token_id,
+                        stopping_criteria=StoppingCriteriaList([
+                            StopOnEvent(stop_event),
+                            StopOnReplyEnd(tokenizer, prompt_length)
+                        ]),
+                        **self._cache_kwargs(model, model_obj, prompt_length + max_new_tokens)
+                    )
+                except Exception as e:
+                    generation_errors.append(e)
+                    streamer.end()  # Unblock the consumer
+
+            threading.Thread(target=run_generate, daemon=True).start()
 
             # Filter out repetitions for cleaner response
-            filtered_response = self._filter_assistant_response(new_response)
+            try:
+                yield from self._filter_assistant_stream(streamer)
+            finally:
+                stop_event.set()
 
-            # Yield chunks for streaming
-            for char in filtered_response:
-                yield char
+            if generation_errors:
+                raise generation_errors[0]
 
         except Exception as e:
             yield f"Error: {str(e)}"
 
     def chat_complete(self, model: str, messages: List[Dict[str, str]],
-                     system_message: str = None) -> str:
+                     system_message: str = None, max_new_tokens: int = MAX_NEW_TOKENS,
+                     do_sample: bool = True) -> str:
         """Get complete chat response from Hugging Face model"""
         response_parts = []
-        for chunk in self.chat_stream(model, messages, system_message):
+        for chunk in self.chat_stream(model, messages, system_message, max_new_tokens, do_sample):
             response_parts.append(chunk)
         return ''.join(response_parts)
 
@@ -182,7 +464,51 @@ class HuggingFaceService:
         """Check if a model is available"""
         return model_name in self.models
 
-# Model factory function
+def prefetch_model_weights(model_names: List[str], done_event=None):
+    """Download model (and PEFT base) weights into the local Hugging Face cache.
+
+    Runs in a separate process so the download/verification work does not hold
+    the GIL of the web process; the in-process lazy load then reads from disk.
+    """
+    from huggingface_hub import snapshot_download
+
+    models = HuggingFaceService().get_available_models()
+    for model_name in model_names:
+        if model_name not in models:
+            logger.warning(f"Model {model_name} not available for pre-loading")
+            continue
+        repos = [model_name]
+        if 'peft_base' in models[model_name]:
+            repos.append(models[model_name]['peft_base'])
+        for repo_id in repos:
+            try:
+                logger.info(f"Prefetching weights for: {repo_id}")
+                snapshot_download(repo_id, allow_patterns=PREFETCH_PATTERNS)
+            except Exception as e:
+                logger.error(f"Failed to prefetch weights for {repo_id}: {str(e)}")
+
+    if done_event is not None:
+        done_event.set()
+
+def start_weights_prefetch(model_names: List[str]):
+    """Start prefetch_model_weights in a spawned process, once per server, and
+    return the event it sets when done"""
+    global _weights_prefetched
+    if _weights_prefetched is None:
+        logger.info(f"Starting pre-loading of models: {model_names}")
+        mp_context = multiprocessing.get_context('spawn')
+        _weights_prefetched = mp_context.Event()
+        mp_context.Process(
+            target=prefetch_model_weights,
+            args=(model_names, _weights_prefetched),
+            daemon=True
+        ).start()
+    return _weights_prefetched
+
+# Factory function with caching
 def create_huggingface_service() -> HuggingFaceService:
-    """Factory function to create HuggingFaceService instance"""
-    return HuggingFaceService()
\ No newline at end of file
+    """Factory function to create HuggingFaceService instance with caching"""
+    global _huggingface_service_instance
+    if _huggingface_service_instance is None:
+        _huggingface_service_instance = HuggingFaceService()
+    return _huggingface_service_instance
\ No newline at end of file
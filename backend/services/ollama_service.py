@@ -1,35 +1,67 @@
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
+import time
+import logging
 from typing import Generator, Dict, Any, List
 from config import Config
 
+logger = logging.getLogger(__name__)
+
+# Global service instance cache
+_ollama_service_instance = None
+
+# Installed models change rarely, so the model list route and availability
+# checks reuse the list for this long instead of querying Ollama every time.
+# This is the only cache of it; pull_model invalidates it via refresh()
+MODELS_TTL = 60  # seconds
+
 class OllamaService:
     def __init__(self):
         self.base_url = Config.OLLAMA_BASE_URL
+        # Keep-alive connection pool shared by all request threads
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=32,
+            # Retries only idempotent calls (GET) on connection errors
+            max_retries=Retry(total=2, backoff_factor=0.1)
+        ))
         self.available_models = {}
+        self._models_loaded_at = 0.0
         self._load_available_models()
     
     def _load_available_models(self):
         """Load available models from Ollama"""
+        self._models_loaded_at = time.monotonic()
         try:
-            response = requests.get(f"{self.base_url}/api/tags")
+            response = self.session.get(f"{self.base_url}/api/tags")
             if response.status_code == 200:
                 models_data = response.json()
+                available_models = {}
                 for model in models_data.get('models', []):
                     name = model['name']
-                    self.available_models[name] = {
+                    available_models[name] = {
                         'name': name,
                         'size': model.get('size', 0),
                         'modified_at': model.get('modified_at', ''),
                         'details': model.get('details', {})
                     }
+                # Swap in the new dict so concurrent readers never see a partial list
+                self.available_models = available_models
         except Exception as e:
-            print(f"Error loading models: {e}")
+            logger.error(f"Error loading models: {e}")
     
     def get_available_models(self) -> Dict[str, Any]:
-        """Get list of available models"""
-        self._load_available_models()  # Refresh models list
+        """Get list of available models, refreshing a list older than MODELS_TTL"""
+        if time.monotonic() - self._models_loaded_at >= MODELS_TTL:
+            self._load_available_models()
         return self.available_models
+
+    def refresh(self):
+        """Mark the model list stale so the next lookup refetches it"""
+        self._models_loaded_at = 0.0
     
     def chat_stream(self, model: str, messages: List[Dict[str, str]], 
                    system_message: str = None) -> Generator[str, None, None]:
@@ -59,31 +91,34 @@ class OllamaService:
         }
         
         try:
-            response = requests.post(
+            # Closing the response (also when the consumer closes this
+            # generator early) drops the connection, which stops Ollama's
+            # generation
+            with self.session.post(
                 f"{self.base_url}/api/chat",
-                json=payload,
+                data=orjson.dumps(payload),
+                headers={"Content-Type": "application/json"},
                 stream=True,
                 timeout=300
-            )
+            ) as response:
+                if response.status_code != 200:
+                    yield f"Error: {response.status_code} - {response.text}"
+                    return
             
-            if response.status_code != 200:
-                yield f"Error: {response.status_code} - {response.text}"
-                return
-            
-            for line in response.iter_lines():
-                if line:
-                    try:
-                        chunk = json.loads(line.decode('utf-8'))
-                        if 'message' in chunk and 'content' in chunk['message']:
-                            content = chunk['message']['content']
-                            if content:
-                                yield content
+                for line in response.iter_lines():
+                    if line:
+                        try:
+                            chunk = orjson.loads(line)  # Parses the raw NDJSON bytes
+                            if 'message' in chunk and 'content' in chunk['message']:
+                                content = chunk['message']['content']
+                                if content:
+                                    yield content
                         
-                        if chunk.get('done', False):
-                            break
+                            if chunk.get('done', False):
+                                break
                             
-                    except json.JSONDecodeError:
-                        continue
+                        except orjson.JSONDecodeError:
+                            continue
                         
         except requests.exceptions.RequestException as e:
             yield f"Error connecting to Ollama: {str(e)}"
@@ -97,20 +132,28 @@ class OllamaService:
         return ''.join(response_parts)
     
     def is_model_available(self, model_name: str) -> bool:
-        """Check if a model is available"""
+        """Check if a model is available, refreshing a model list older than MODELS_TTL"""
+        if time.monotonic() - self._models_loaded_at >= MODELS_TTL:
+            self._load_available_models()
         return model_name in self.available_models
     
     def pull_model(self, model_name: str) -> bool:
         """Pull a model from Ollama registry"""
         try:
             payload = {"name": model_name}
-            response = requests.post(f"{self.base_url}/api/pull", json=payload)
-            return response.status_code == 200
+            response = self.session.post(f"{self.base_url}/api/pull", json=payload)
+            if response.status_code == 200:
+                self.refresh()  # Pick up the new model on the next lookup
+                return True
+            return False
         except Exception as e:
-            print(f"Error pulling model {model_name}: {e}")
+            logger.error(f"Error pulling model {model_name}: {e}")
             return False
 
-# Model factory function
+# Factory function with caching
 def create_ollama_service() -> OllamaService:
-    """Factory function to create OllamaService instance"""
-    return OllamaService()
\ No newline at end of file
+    """Factory function to create OllamaService instance with caching"""
+    global _ollama_service_instance
+    if _ollama_service_instance is None:
+        _ollama_service_instance = OllamaService()
+    return _ollama_service_instance
\ No newline at end of file
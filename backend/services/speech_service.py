@@ -1,13 +1,37 @@
-import librosa
-from transformers import WhisperForConditionalGeneration, WhisperProcessor
+import soundfile as sf
+import soxr
+# torch/transformers are imported when Whisper is first loaded, so TTS-only
+# use of the service (e.g. background message audio) never loads them
 import tempfile
 import os
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+import shutil
 import hashlib
+import unicodedata
 from gradio_client import Client
+from config import Config
+import logging
+
+logger = logging.getLogger(__name__)
 
 # Global service instance cache
 _speech_service_instance = None
 
+WHISPER_MODEL_ID = "GiftMark/akan-whisper-model"
+ASR_SAMPLE_RATE = 16000
+# Whisper's input window; longer clips go through chunked long-form decoding
+ASR_WINDOW_SECONDS = 30
+# Concurrent short transcriptions arriving within the window share one generate
+ASR_BATCH_SIZE = 8
+ASR_BATCH_WINDOW = 0.05  # seconds
+# Clips returned this recently are never evicted, so a caller can still
+# send the path it was just given
+TTS_RECENT_KEYS = 8
+
 class SpeechService:
     def __init__(self):
         # TTS client
@@ -16,46 +40,258 @@ class SpeechService:
         # TTS cache directory
         self.tts_cache_dir = os.path.join(os.getcwd(), 'tts_cache')
         os.makedirs(self.tts_cache_dir, exist_ok=True)
+        self._tts_cache_lock = threading.Lock()
+        self._load_tts_cache_index()
+        self._tts_recent = deque(maxlen=TTS_RECENT_KEYS)
+        # Cache key -> Future for syntheses in progress, so concurrent requests
+        # for the same text share one TTS API call
+        self._tts_inflight = {}
 
         # Audio files directory for pre-generated message audio
         self.audio_dir = os.path.join(os.getcwd(), 'audio')
         os.makedirs(self.audio_dir, exist_ok=True)
 
-        # New: Load Whisper model and processor for ASR
+        # Whisper model and processor for ASR, loaded on first transcription
         self.model = None
         self.processor = None
-        self._load_whisper_model()
+        self.long_form_pipeline = None
+        self.ct2_model = None
+        self._whisper_lock = threading.Lock()
+
+        # Pending short transcriptions, batched by a worker thread that
+        # starts with the Whisper model
+        self._asr_queue = queue.Queue()
 
     def _get_cache_key(self, text, language, speaker_id):
         """Generate a unique cache key for TTS requests"""
-        # Create a hash of the input parameters
-        cache_string = f"{text}|{language}|{speaker_id}"
-        return hashlib.md5(cache_string.encode('utf-8')).hexdigest() + '.wav'
+        # Hash the input parameters (BLAKE2b, 128-bit digest -> 32 hex chars)
+        hasher = hashlib.blake2b(digest_size=16)
+        hasher.update(text.encode('utf-8'))
+        hasher.update(f"|{language}|{speaker_id}".encode('utf-8'))
+        return hasher.hexdigest() + '.wav'
+
+    def _load_tts_cache_index(self):
+        """Index cached clips in memory (cache key -> size in bytes, least
+        recently used first) so lookups don't stat the cache directory"""
+        entries = []
+        with os.scandir(self.tts_cache_dir) as scan:
+            for entry in scan:
+                if entry.is_file() and entry.name.endswith('.wav'):
+                    stat = entry.stat()
+                    entries.append((stat.st_atime, entry.name, stat.st_size))
+        entries.sort()
+        self._tts_cache_index = OrderedDict((name, size) for _, name, size in entries)
+        self._tts_cache_bytes = sum(self._tts_cache_index.values())
+
+    def _add_to_tts_cache_index(self, cache_key, size):
+        """Record a new cached clip and evict LRU clips over TTS_CACHE_MAX_BYTES,
+        keeping the new clip and the ones just returned to callers"""
+        with self._tts_cache_lock:
+            self._tts_cache_bytes += size - self._tts_cache_index.pop(cache_key, 0)
+            self._tts_cache_index[cache_key] = size
+            self._tts_recent.append(cache_key)
+            if self._tts_cache_bytes <= Config.TTS_CACHE_MAX_BYTES:
+                return
+            evicted = []
+            for key, key_size in self._tts_cache_index.items():
+                if self._tts_cache_bytes <= Config.TTS_CACHE_MAX_BYTES:
+                    break
+                if key not in self._tts_recent:
+                    evicted.append(key)
+                    self._tts_cache_bytes -= key_size
+            for key in evicted:
+                del self._tts_cache_index[key]
+                # Message audio hard-links to cache files, so it survives this
+                try:
+                    os.unlink(os.path.join(self.tts_cache_dir, key))
+                except FileNotFoundError:
+                    pass
 
     def _load_whisper_model(self):
         """Lazy-load the Whisper model to avoid startup delays."""
-        if self.model is None:
-            print("Loading Whisper ASR model...")
-            self.model = WhisperForConditionalGeneration.from_pretrained("GiftMark/akan-whisper-model")
-            self.processor = WhisperProcessor.from_pretrained("GiftMark/akan-whisper-model")
-            print("Whisper model loaded.")
+        if self.processor is not None:
+            return
+        with self._whisper_lock:
+            # Another request may have finished loading while we waited
+            if self.processor is not None:
+                return
 
-    def transcribe_audio(self, audio_file_path, language="tw"):
-        """Transcribe audio file to text using Hugging Face Whisper model"""
+            from transformers import WhisperForConditionalGeneration, WhisperProcessor, pipeline
+
+            logger.info("Loading Whisper ASR model...")
+            processor = WhisperProcessor.from_pretrained(WHISPER_MODEL_ID)
+            if Config.WHISPER_CT2_DIR:
+                self._load_ct2_model()
+            else:
+                self.model = WhisperForConditionalGeneration.from_pretrained(WHISPER_MODEL_ID)
+                if Config.WHISPER_INT8:
+                    self._quantize_whisper_model()
+                if Config.TORCH_COMPILE:
+                    self._compile_whisper_model()
+                self.long_form_pipeline = pipeline(
+                    "automatic-speech-recognition",
+                    model=self.model,
+                    tokenizer=processor.tokenizer,
+                    feature_extractor=processor.feature_extractor,
+                    chunk_length_s=ASR_WINDOW_SECONDS,
+                    batch_size=ASR_BATCH_SIZE,
+                    device=self.model.device
+                )
+            threading.Thread(target=self._asr_batch_worker, daemon=True).start()
+            # Publish the processor last: it marks the model as ready
+            self.processor = processor
+            logger.info("Whisper model loaded.")
+
+    def _load_ct2_model(self):
+        """Load (converting once if needed) an int8 CTranslate2 Whisper model"""
+        import ctranslate2
+
+        if not os.path.isdir(Config.WHISPER_CT2_DIR):
+            logger.info(f"Converting Whisper model to CTranslate2 in {Config.WHISPER_CT2_DIR}...")
+            ctranslate2.converters.TransformersConverter(WHISPER_MODEL_ID).convert(
+                Config.WHISPER_CT2_DIR, quantization="int8"
+            )
+
+        if ctranslate2.get_cuda_device_count() > 0:
+            device, compute_type = "cuda", "int8_float16"
+        else:
+            device, compute_type = "cpu", "int8"
+        self.ct2_model = ctranslate2.models.Whisper(Config.WHISPER_CT2_DIR, device=device, compute_type=compute_type)
+
+    def _quantize_whisper_model(self):
+        """Swap the CPU Whisper model's Linear layers for dynamic int8 ones"""
+        import torch
+
+        if self.model.device.type != 'cpu':
+            return
+        # int8 kernels need a quantized engine (fbgemm/x86/onednn on x86 with
+        # VNNI, qnnpack on ARM); without one, keep FP32
+        if torch.backends.quantized.engine == 'none':
+            logger.warning("No quantized engine available, keeping FP32 Whisper")
+            return
+        self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    def _compile_whisper_model(self):
+        """Compile the Whisper forward pass and warm it up with 30s of silence;
+        falls back to eager on failure"""
+        import torch
+
+        if not hasattr(torch, 'compile'):
+            return
+        eager_forward = self.model.forward
+        try:
+            # Without CUDA graphs: they are recorded per thread, and Whisper
+            # runs on both the batch worker and long-form request threads
+            self.model.forward = torch.compile(eager_forward, mode="default", fullgraph=False)
+            # Whisper always pads input features to 3000 frames (30s)
+            dummy_features = torch.zeros(1, self.model.config.num_mel_bins, 3000,
+                                         dtype=self.model.dtype, device=self.model.device)
+            with torch.inference_mode():
+                self.model.generate(dummy_features, max_new_tokens=1)
+        except Exception as e:
+            self.model.forward = eager_forward
+            logger.warning(f"torch.compile failed for Whisper, using eager mode: {str(e)}")
+
+    def _asr_batch_worker(self):
+        """Collect queued (audio_array, future) pairs for up to ASR_BATCH_WINDOW
+        and transcribe them with a single padded generate call"""
+        while True:
+            batch = [self._asr_queue.get()]
+            deadline = time.monotonic() + ASR_BATCH_WINDOW
+            while len(batch) < ASR_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._asr_queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                transcriptions = self._generate_transcriptions([audio_array for audio_array, _ in batch])
+                for (_, future), transcription in zip(batch, transcriptions):
+                    future.set_result(transcription)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+
+    def _generate_transcriptions(self, audio_arrays):
+        """Transcribe a batch of clips of at most ASR_WINDOW_SECONDS each"""
+        if self.ct2_model is not None:
+            import ctranslate2
+
+            features = self.processor(audio_arrays, sampling_rate=ASR_SAMPLE_RATE, return_tensors="np").input_features
+            # Only the start token: the Akan-tuned model predicts its own language/task tokens
+            prompt = self.processor.tokenizer.convert_tokens_to_ids(["<|startoftranscript|>"])
+            results = self.ct2_model.generate(
+                ctranslate2.StorageView.from_array(features),
+                [prompt] * len(audio_arrays),
+                beam_size=1
+            )
+            return [
+                self.processor.tokenizer.decode(result.sequences_ids[0], skip_special_tokens=True).strip()
+                for result in results
+            ]
+
+        import torch
+
+        inputs = self.processor(
+            audio_arrays,
+            sampling_rate=ASR_SAMPLE_RATE,
+            return_tensors="pt",
+            return_attention_mask=True
+        )
+        input_features = inputs.input_features.to(device=self.model.device, dtype=self.model.dtype)
+        attention_mask = inputs.attention_mask.to(self.model.device)
+
+        # Language could be passed here, but the model is Akan-tuned
+        with torch.inference_mode():
+            predicted_ids = self.model.generate(input_features, attention_mask=attention_mask, num_beams=1)
+
+        return [transcription.strip() for transcription in
+                self.processor.batch_decode(predicted_ids, skip_special_tokens=True)]
+
+    def _load_audio(self, audio_file_path):
+        """Decode audio to a mono float32 array at ASR_SAMPLE_RATE"""
         try:
-            # Load audio into array (Librosa handles MP3/WAV, resamples to 16kHz)
-            audio_array, sr = librosa.load(audio_file_path, sr=16000)
+            # libsndfile (WAV/FLAC/OGG/MP3) decodes in C without audioread
+            audio_array, sr = sf.read(audio_file_path, dtype='float32', always_2d=False)
+        except sf.LibsndfileError:
+            # Containers libsndfile can't read (e.g. browser webm uploads)
+            # go through librosa's audioread/ffmpeg path in one step
+            import librosa
+            audio_array, _ = librosa.load(audio_file_path, sr=ASR_SAMPLE_RATE)
+            return audio_array
 
-            # Process with Whisper
-            inputs = self.processor(audio_array, sampling_rate=16000, return_tensors="pt").input_features
+        if audio_array.ndim > 1:
+            audio_array = audio_array.mean(axis=1)
+        if sr != ASR_SAMPLE_RATE:
+            audio_array = soxr.resample(audio_array, sr, ASR_SAMPLE_RATE)
+        return audio_array
 
-            # Generate transcription (language can be specified if needed, but model is Akan-tuned)
-            # predicted_ids = self.model.generate(inputs, language=language if language else None)
-            predicted_ids = self.model.generate(inputs)
+    def transcribe_audio(self, audio_file_path, language="tw"):
+        """Transcribe audio file to text using Hugging Face Whisper model"""
+        try:
+            self._load_whisper_model()
+            audio_array = self._load_audio(audio_file_path)
 
-            transcription = self.processor.batch_decode(predicted_ids, skip_special_tokens=True)[0]
+            # Long clips: chunked long-form decoding, chunks batched on the model
+            window = ASR_WINDOW_SECONDS * ASR_SAMPLE_RATE
+            if len(audio_array) > window and self.ct2_model is not None:
+                # CTranslate2 has no long-form pipeline: decode 30s windows as one batch
+                chunks = [audio_array[start:start + window] for start in range(0, len(audio_array), window)]
+                return " ".join(self._generate_transcriptions(chunks)).strip()
+            if len(audio_array) > window:
+                result = self.long_form_pipeline(
+                    {"raw": audio_array, "sampling_rate": ASR_SAMPLE_RATE},
+                    generate_kwargs={"num_beams": 1}
+                )
+                return result["text"].strip()
 
-            return transcription.strip()
+            # Short clips: batched with other pending requests
+            future = Future()
+            self._asr_queue.put((audio_array, future))
+            return future.result()
 
         except Exception as e:
             raise Exception(f"ASR transcription failed: {str(e)}")
@@ -63,45 +299,100 @@ class SpeechService:
     def synthesize_text(self, text, language="tw", speaker_id="twi_speaker_4"):
         """Synthesize text to speech using Ghana-NLP Southern Ghana TTS API"""
         try:
+            # Canonicalize to NFC so composed and decomposed spellings of the
+            # same Twi text share a cache entry (is_normalized is a quick scan)
+            if not text.isascii() and not unicodedata.is_normalized("NFC", text):
+                text = unicodedata.normalize("NFC", text)
+
             # Generate cache key
             cache_key = self._get_cache_key(text, language, speaker_id)
             cache_path = os.path.join(self.tts_cache_dir, cache_key)
 
-            # Check if cached file exists
-            if os.path.exists(cache_path):
-                print(f"[TTS Cache] Using cached audio: {cache_path}")
+            # Check the in-memory cache index, then join a synthesis of the
+            # same text that is already in flight (one lock, so a synthesis
+            # finishing in between can't be missed). The index is trusted
+            # here; callers that find the file gone use discard_cached_audio
+            with self._tts_cache_lock:
+                cached = cache_key in self._tts_cache_index
+                if cached:
+                    self._tts_cache_index.move_to_end(cache_key)
+                    self._tts_recent.append(cache_key)
+                else:
+                    future = self._tts_inflight.get(cache_key)
+                    owner = future is None
+                    if owner:
+                        future = Future()
+                        self._tts_inflight[cache_key] = future
+            if cached:
+                logger.debug(f"[TTS Cache] Using cached audio: {cache_path}")
                 return cache_path
+            if not owner:
+                logger.debug(f"[TTS Cache] Waiting for in-flight audio: {cache_path}")
+                return future.result()
 
-            # Map parameters to new API
-            lang = "Asante Twi"  # Default language mapping
-            speaker = "Female"   # Default speaker mapping
+            try:
+                future.set_result(self._request_tts(text, cache_key, cache_path))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self._tts_cache_lock:
+                    del self._tts_inflight[cache_key]
+            return future.result()
 
-            print(f"[TTS Cache] Generating new audio for: '{text[:50]}...'")
+        except Exception as e:
+            raise Exception(f"TTS synthesis failed: {str(e)}")
 
-            result = self.tts_client.predict(
-                text=text,
-                lang=lang,
-                speaker=speaker,
-                api_name="/predict"
-            )
+    def discard_cached_audio(self, audio_path):
+        """Drop a clip whose file turned out to be missing (evicted by another
+        worker process, or removed by hand) so the next synthesize_text call
+        synthesizes it again"""
+        with self._tts_cache_lock:
+            size = self._tts_cache_index.pop(os.path.basename(audio_path), None)
+            if size is not None:
+                self._tts_cache_bytes -= size
 
-            # Result is a file path to the audio file
-            if isinstance(result, str) and os.path.exists(result):
-                # Read the audio file and save to cache
-                with open(result, 'rb') as audio_file:
-                    audio_bytes = audio_file.read()
+    def _request_tts(self, text, cache_key, cache_path):
+        """Call the TTS API and move the resulting clip into the cache"""
+        # Map parameters to new API
+        lang = "Asante Twi"  # Default language mapping
+        speaker = "Female"   # Default speaker mapping
 
-                # Save to cache
-                with open(cache_path, 'wb') as cache_file:
-                    cache_file.write(audio_bytes)
+        logger.debug(f"[TTS Cache] Generating new audio for: '{text[:50]}...'")
 
-                print(f"[TTS Cache] Saved to cache: {cache_path}")
-                return cache_path
-            else:
-                raise Exception(f"Unexpected result from TTS API: {result}")
+        result = self.tts_client.predict(
+            text=text,
+            lang=lang,
+            speaker=speaker,
+            api_name="/predict"
+        )
 
+        # Result is a file path to the audio file
+        if not isinstance(result, str):
+            raise Exception(f"Unexpected result from TTS API: {result}")
+
+        # The gradio_client file is disposable: move it next to the cache
+        # entry (a rename on the same filesystem, copy + delete otherwise),
+        # then rename it into place so readers never see a partial file. A
+        # missing result file surfaces as FileNotFoundError from the move, so
+        # no separate exists() check; one stat gives the size
+        fd, part_path = tempfile.mkstemp(suffix='.part', dir=self.tts_cache_dir)
+        os.close(fd)
+        try:
+            shutil.move(result, part_path)
+            size = os.stat(part_path).st_size
+            os.replace(part_path, cache_path)
         except Exception as e:
-            raise Exception(f"TTS synthesis failed: {str(e)}")
+            try:
+                os.unlink(part_path)
+            except FileNotFoundError:
+                pass
+            if isinstance(e, FileNotFoundError) and e.filename == result:
+                raise Exception(f"Unexpected result from TTS API: {result}")
+            raise
+        self._add_to_tts_cache_index(cache_key, size)
+
+        logger.debug(f"[TTS Cache] Saved to cache: {cache_path}")
+        return cache_path
 
     def generate_message_audio(self, message_id, text, language="tw", speaker_id="twi_speaker_4"):
         """Generate audio for a specific message and return the URL path"""
@@ -113,16 +404,24 @@ class SpeechService:
             message_audio_filename = f"message_{message_id}.wav"
             message_audio_path = os.path.join(self.audio_dir, message_audio_filename)
 
-            # Copy the cached/temp file to the message audio location
-            with open(audio_path, 'rb') as src_file:
-                with open(message_audio_path, 'wb') as dst_file:
-                    dst_file.write(src_file.read())
+            # Hard-link the cached file to the message audio location, falling
+            # back to copyfile (sendfile on Linux) across filesystems or when
+            # the message file already exists
+            try:
+                os.link(audio_path, message_audio_path)
+            except FileNotFoundError:
+                # The indexed clip is gone; synthesize it again
+                self.discard_cached_audio(audio_path)
+                audio_path = self.synthesize_text(text, language, speaker_id)
+                shutil.copyfile(audio_path, message_audio_path)
+            except OSError:
+                shutil.copyfile(audio_path, message_audio_path)
 
             # Return the URL path for the frontend
             return f"/audio/{message_audio_filename}"
 
         except Exception as e:
-            print(f"[TTS] Failed to generate audio for message {message_id}: {str(e)}")
+            logger.error(f"[TTS] Failed to generate audio for message {message_id}: {str(e)}")
             return None  # Return None on failure, message still saves
 
 # Factory function with caching
@@ -130,6 +429,6 @@ def create_speech_service():
     """Factory function to create SpeechService instance with caching"""
     global _speech_service_instance
     if _speech_service_instance is None:
-        print("[SpeechService] Creating new SpeechService instance...")
+        logger.info("[SpeechService] Creating new SpeechService instance...")
         _speech_service_instance = SpeechService()
     return _speech_service_instance
\ No newline at end of file
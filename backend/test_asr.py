@@ -16,12 +16,13 @@ def create_test_audio():
     sample_rate = 16000
     duration = 1.0
     frequency = 440.0
-    t = np.linspace(0, duration, int(sample_rate * duration), False)
-    audio = np.sin(frequency * 2 * np.pi * t)
+    # float32 throughout (numpy defaults to float64)
+    t = np.linspace(0, duration, int(sample_rate * duration), False, dtype=np.float32)
+    audio = np.sin(np.float32(frequency * 2 * np.pi) * t)
 
-    # Save as WAV
+    # Save as 16-bit PCM WAV
     with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as temp_file:
-        sf.write(temp_file.name, audio, sample_rate)
+        sf.write(temp_file.name, audio, sample_rate, subtype='PCM_16')
         return temp_file.name
 
 def test_asr():
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Test script for the HuggingFace KV cache selection.
+Checks the generate() kwargs _cache_kwargs produces for HF_KV_CACHE_BITS /
+HF_KV_CACHE_BACKEND, without loading a model.
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from config import Config
+from services.huggingface_service import HuggingFaceService
+
+class FakeModel:
+    """Stands in for a loaded model; the quantized path only needs an object"""
+    _can_compile_fullgraph = False
+
+def cache_kwargs(bits, backend, backend_installed):
+    """_cache_kwargs on a fresh service with the given settings"""
+    Config.HF_KV_CACHE_BITS = bits
+    Config.HF_KV_CACHE_BACKEND = backend
+    Config.TORCH_COMPILE = False
+    service = HuggingFaceService()
+    if backend_installed is not None:
+        service._kv_cache_backend_ok = backend_installed
+    return service._cache_kwargs('fake-model', FakeModel(), 64)
+
+def test_cache_kwargs():
+    """Check the kwargs for each setting"""
+    print("Testing KV cache kwargs...")
+
+    quantized = lambda backend, bits: {
+        'cache_implementation': 'quantized',
+        'cache_config': {'backend': backend, 'nbits': bits}
+    }
+    cases = [
+        ("unset", cache_kwargs(None, 'quanto', True), {}),
+        ("quanto, 8 bits", cache_kwargs(8, 'quanto', True), quantized('quanto', 8)),
+        ("hqq, 4 bits", cache_kwargs(4, 'hqq', True), quantized('hqq', 4)),
+        ("backend not installed", cache_kwargs(8, 'quanto', False), {}),
+        ("unknown backend", cache_kwargs(8, 'HQQ-typo', None), {}),
+    ]
+
+    ok = True
+    for description, produced, expected in cases:
+        passed = produced == expected
+        print(f"{'✓' if passed else '✗'} {description}: {produced}")
+        ok = ok and passed
+    return ok
+
+def main():
+    """Run all tests"""
+    success = test_cache_kwargs()
+    if success:
+        print("\n=== All tests passed! ===")
+    return 0 if success else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
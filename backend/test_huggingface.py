@@ -6,39 +6,48 @@ This script tests loading the FelixYaw/twi-gpt-lora-kaggle model and generating
 
 import sys
 import os
+import io
+import time
+import logging
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from services.huggingface_service import create_huggingface_service
 
-def test_model_loading():
+log = logging.getLogger(__name__)
+
+# Enough tokens to check the plumbing; greedy decoding keeps runs deterministic
+TEST_GENERATION_KWARGS = {"max_new_tokens": 32, "do_sample": False}
+# The streaming test checks time to first chunk, then stops after a few chunks
+TTFT_LIMIT = 5.0  # seconds
+STREAM_CHUNKS = 5
+
+def test_model_loading(service):
     """Test loading the Hugging Face model"""
-    print("Testing Hugging Face model loading...")
+    log.info("Testing Hugging Face model loading...")
 
     try:
-        service = create_huggingface_service()
         models = service.get_available_models()
-        print(f"Available models: {list(models.keys())}")
+        log.info("Available models: %s", list(models.keys()))
 
         # Test both models
         test_models = ["FelixYaw/twi-gpt-lora-kaggle", "FelixYaw/twi-lora-model"]
         for model_name in test_models:
             if service.is_model_available(model_name):
-                print(f"✓ Model {model_name} is available")
+                log.info("✓ Model %s is available", model_name)
             else:
-                print(f"✗ Model {model_name} is not available")
+                log.error("✗ Model %s is not available", model_name)
                 return False
 
         return True
     except Exception as e:
-        print(f"✗ Error loading model: {e}")
+        log.error("✗ Error loading model: %s", e)
         return False
 
-def test_model_generation():
+def test_model_generation(service):
     """Test generating text with the model"""
-    print("\nTesting text generation...")
+    log.info("\nTesting text generation...")
 
     try:
-        service = create_huggingface_service()
         model_name = "FelixYaw/twi-gpt-lora-kaggle"
 
         # Test messages
@@ -46,73 +55,99 @@ def test_model_generation():
             {"role": "user", "content": "Hello, how are you?"}
         ]
 
-        print("Generating response...")
-        response = service.chat_complete(model_name, messages)
-        print(f"Response: {response}")
+        log.info("Generating response...")
+        response = service.chat_complete(model_name, messages, **TEST_GENERATION_KWARGS)
+        log.info("Response: %s", response)
 
         if response and len(response.strip()) > 0:
-            print("✓ Text generation successful")
+            log.info("✓ Text generation successful")
             return True
         else:
-            print("✗ Empty response generated")
+            log.error("✗ Empty response generated")
             return False
 
     except Exception as e:
-        print(f"✗ Error generating text: {e}")
+        log.error("✗ Error generating text: %s", e)
         return False
 
-def test_streaming_generation():
+def test_streaming_generation(service):
     """Test streaming text generation"""
-    print("\nTesting streaming text generation...")
+    log.info("\nTesting streaming text generation...")
 
     try:
-        service = create_huggingface_service()
         model_name = "FelixYaw/twi-gpt-lora-kaggle"
 
         messages = [
             {"role": "user", "content": "Tell me a short story."}
         ]
 
-        print("Streaming response:")
-        chunks = []
-        for chunk in service.chat_stream(model_name, messages):
-            print(chunk, end="", flush=True)
-            chunks.append(chunk)
-
-        response = ''.join(chunks)
-        print(f"\n\nFull response: {response}")
+        buffer = io.StringIO()
+        append = buffer.write  # Local binding for the per-chunk call
+        log_chunks = log.isEnabledFor(logging.DEBUG)
+        ttft = None
+        start = time.perf_counter()
+        stream = service.chat_stream(model_name, messages, **TEST_GENERATION_KWARGS)
+        for index, chunk in enumerate(stream, 1):
+            if ttft is None:
+                ttft = time.perf_counter() - start
+            append(chunk)
+            if __debug__:
+                # Compiled out entirely under python -O
+                if log_chunks:
+                    log.debug("Chunk %d: %r", index, chunk)
+            if index >= STREAM_CHUNKS:
+                break
+        # Closing the stream stops the service's background generate
+        stream.close()
+
+        response = buffer.getvalue()
+        log.info("Streamed response: %s", response)
+
+        if ttft is None or not response.strip():
+            log.error("✗ Empty streaming response")
+            return False
 
-        if response and len(response.strip()) > 0:
-            print("✓ Streaming generation successful")
-            return True
-        else:
-            print("✗ Empty streaming response")
+        log.info("Time to first chunk: %.2fs", ttft)
+        if ttft > TTFT_LIMIT:
+            log.error("✗ First chunk took longer than %.1fs", TTFT_LIMIT)
             return False
 
+        log.info("✓ Streaming generation successful")
+        return True
+
     except Exception as e:
-        print(f"✗ Error in streaming: {e}")
+        log.error("✗ Error in streaming: %s", e)
         return False
 
 def main():
     """Run all tests"""
-    print("=== Hugging Face Model Test ===\n")
+    # LOG_LEVEL=DEBUG also logs each streamed chunk; WARNING keeps CI quiet
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL') or 'INFO', format='%(message)s')
+    log.info("=== Hugging Face Model Test ===\n")
+
+    # Create the service once; every test reuses its loaded model
+    try:
+        service = create_huggingface_service()
+    except Exception as e:
+        log.error("✗ Error creating service: %s", e)
+        return 1
 
     # Test 1: Model loading
-    if not test_model_loading():
-        print("\nModel loading failed. Exiting.")
+    if not test_model_loading(service):
+        log.error("\nModel loading failed. Exiting.")
         return 1
 
     # Test 2: Text generation
-    if not test_model_generation():
-        print("\nText generation failed. Exiting.")
+    if not test_model_generation(service):
+        log.error("\nText generation failed. Exiting.")
         return 1
 
     # Test 3: Streaming generation
-    if not test_streaming_generation():
-        print("\nStreaming generation failed. Exiting.")
+    if not test_streaming_generation(service):
+        log.error("\nStreaming generation failed. Exiting.")
         return 1
 
-    print("\n=== All tests passed! ===")
+    log.info("\n=== All tests passed! ===")
     return 0
 
 if __name__ == "__main__":
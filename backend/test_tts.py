@@ -7,46 +7,61 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from services.speech_service import create_speech_service
 import tempfile
+import unicodedata
+import logging
+
+log = logging.getLogger(__name__)
+
+# Normalized once at import; NFC matches the form the service caches under
+TEXT = unicodedata.normalize("NFC", "Nanso, ɛberɛ a mesuntiiɛ no, wɔde anigyeɛ boaa wɔn ho ano; ntohyɛsofoɔ twaa me ho hyiaaɛ a mennim na wɔdii me ho nsekuro a wɔantwa so da")
 
 def test_tts():
-    print("Testing TTS service...")
+    log.info("Testing TTS service...")
 
     try:
         # Create service
         service = create_speech_service()
-        print("Service created successfully")
+        log.info("Service created successfully")
 
         # Test synthesis
-        text = "Nanso, ɛberɛ a mesuntiiɛ no, wɔde anigyeɛ boaa wɔn ho ano; ntohyɛsofoɔ twaa me ho hyiaaɛ a mennim na wɔdii me ho nsekuro a wɔantwa so da"
-        print(f"Synthesizing text: '{text}'")
+        text = TEXT
+        log.info("Synthesizing text: '%s'", text)
 
         audio_path = service.synthesize_text(text)
-        print(f"Audio saved to: {audio_path}")
+        log.info("Audio saved to: %s", audio_path)
 
-        # Check if file exists and has content
-        if os.path.exists(audio_path) and os.path.getsize(audio_path) > 0:
-            print("✓ TTS test successful!")
-            print(f"Audio file size: {os.path.getsize(audio_path)} bytes")
+        # Check if file exists and has content (one stat for both)
+        try:
+            size = os.stat(audio_path).st_size
+        except FileNotFoundError:
+            size = 0
+        if size > 0:
+            log.info("✓ TTS test successful!")
+            log.info("Audio file size: %d bytes", size)
         else:
-            print("✗ Audio file not created or empty")
+            log.error("✗ Audio file not created or empty")
             return False
 
     except Exception as e:
-        print(f"✗ TTS test failed: {e}")
+        log.error("✗ TTS test failed: %s", e)
         return False
 
     finally:
         # Don't clean up cached files - they should persist
         # Only clean up if it's a temp file (not in cache directory)
-        if 'audio_path' in locals() and os.path.exists(audio_path):
+        if 'audio_path' in locals():
             if not audio_path.startswith(os.path.join(os.getcwd(), 'tts_cache')):
-                os.unlink(audio_path)
-                print("Cleaned up temp audio file")
+                try:
+                    os.unlink(audio_path)
+                    log.info("Cleaned up temp audio file")
+                except FileNotFoundError:
+                    pass
             else:
-                print("Kept cached audio file")
+                log.info("Kept cached audio file")
 
     return True
 
 if __name__ == "__main__":
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL') or 'INFO', format='%(message)s')
     success = test_tts()
     sys.exit(0 if success else 1)
\ No newline at end of file